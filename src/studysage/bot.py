@@ -5,153 +5,152 @@ StudySage Telegram Bot - AI-powered study assistant using Google Gemini
 
 import os
 import logging
+import logging.handlers
+import queue
 import asyncio
 import tempfile
 import json
-import datetime
+import time
 import random
-from typing import Final, Dict, List
+import hashlib
+import operator
+import io
+import httpx
+import orjson
+import functools
+import html
+import re
+import secrets
+import weakref
+from itertools import islice
+from typing import Final, Dict, Iterator, List, Optional, Set, Tuple
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler
+from telegram.constants import ParseMode
+from telegram.ext import AIORateLimiter, ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler
+from telegram.request import HTTPXRequest
 from google import genai
+from google.genai import errors, types
+
+from .cache import QuizPool, ResponseCache, SemanticCache, make_cache_key, normalize_prompt
+from .storage import SUBJECT_BITS, SUBJECTS, UserState, UserStore, subject_names
 
 # Configure logging
+# Set STUDYSAGE_LOG_LEVEL=WARNING in production to skip per-message INFO records
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=os.environ.get('STUDYSAGE_LOG_LEVEL', 'INFO').upper()
 )
 logger = logging.getLogger(__name__)
 
 # Bot configuration
 BOT_TOKEN: Final = os.environ.get('TELEGRAM_BOT_TOKEN')
 GEMINI_API_KEY: Final = os.environ.get('GEMINI_API_KEY')
+CACHE_PATH: Final = os.environ.get('STUDYSAGE_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'studysage_cache.db'))
+USER_DB_PATH: Final = os.environ.get('STUDYSAGE_DB_PATH', 'studysage.db')
+# Public HTTPS base URL; when set the bot receives updates by webhook instead of polling
+WEBHOOK_URL: Final = os.environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET: Final = os.environ.get('WEBHOOK_SECRET', '')
+PORT: Final = int(os.environ.get('PORT', '8443'))
+# Gemini models for answers and for the semantic cache embeddings
+MODEL_NAME: Final = "gemini-2.0-flash-001"
+EMBEDDING_MODEL_NAME: Final = "gemini-embedding-001"
+# Embeddings are truncated to this size, which keeps stored vectors and the pure-Python
+# similarity scans small (the model's default is 3072). Semantic cache namespaces
+# include the model name, so vectors from different models are never compared
+EMBEDDING_DIMENSIONS: Final = 768
 
-# Initialize Gemini AI client
+# Initialize Gemini AI client, once per process. A custom transport makes the async SDK
+# use one shared httpx pool with HTTP/2 multiplexing, so concurrent requests reuse warm
+# TLS connections. The timeout (milliseconds) stops a stalled request from holding a
+# user's request slot indefinitely
 if GEMINI_API_KEY:
     os.environ["GEMINI_API_KEY"] = GEMINI_API_KEY
-    genai_client = genai.Client()
+    genai_client = genai.Client(http_options=types.HttpOptions(timeout=30_000, async_client_args={
+        'transport': httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        )
+    }))
 else:
-    logger.error("GEMINI_API_KEY not found in environment variables")
+    logger.error("GEMINI_API_KEY not found in environment variables, AI features are disabled")
     genai_client = None
 
-class StudySageBot:
-    def __init__(self):
-        self.model = "gemini-2.0-flash-001"
-        # User data storage (in production, use a proper database)
-        self.user_data: Dict[int, Dict] = {}
-        
-    def get_user_data(self, user_id: int) -> Dict:
-        """Get or create user data."""
-        if user_id not in self.user_data:
-            self.user_data[user_id] = {
-                'study_streak': 0,
-                'total_questions': 0,
-                'correct_answers': 0,
-                'subjects_studied': set(),
-                'last_activity': None,
-                'level': 1,
-                'xp': 0,
-                'preferences': {
-                    'difficulty': 'medium',
-                    'reminder_time': None,
-                    'favorite_subjects': []
-                }
-            }
-        return self.user_data[user_id]
-        
-    def update_user_stats(self, user_id: int, subject: str = None, correct: bool = None):
-        """Update user statistics and XP."""
-        data = self.get_user_data(user_id)
-        data['last_activity'] = datetime.datetime.now().isoformat()
-        
-        if subject:
-            data['subjects_studied'].add(subject)
-            
-        if correct is not None:
-            data['total_questions'] += 1
-            if correct:
-                data['correct_answers'] += 1
-                data['xp'] += 10
-            else:
-                data['xp'] += 2
-                
-        # Level up system
-        new_level = min(10, data['xp'] // 100 + 1)
-        if new_level > data['level']:
-            data['level'] = new_level
-            return True  # Level up!
-        return False
-        
-    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Send a message when the command /start is issued."""
-        user_id = update.effective_user.id
-        user_data = self.get_user_data(user_id)
-        user_name = update.effective_user.first_name or "Student"
-        
-        welcome_message = f"""
-🎓 **Welcome back, {user_name}!** 🤖✨
+# Static reply texts, built once at import instead of on every command. They are sent
+# with HTML parse mode, which unlike legacy Markdown doesn't choke on stray * or _ in
+# names; anything interpolated into them must go through html.escape
+_WELCOME_MESSAGE: Final = """
+🎓 <b>Welcome back, {user_name}!</b> 🤖✨
 
-🔥 **StudySage Pro** - Your Ultimate AI Study Companion
+🔥 <b>StudySage Pro</b> - Your Ultimate AI Study Companion
 
-🏆 **Your Progress:**
-• Level {user_data['level']} 🎆 ({user_data['xp']} XP)
-• Study Streak: {user_data['study_streak']} days 🔥
-• Questions Answered: {user_data['total_questions']}
-• Accuracy: {(user_data['correct_answers']/max(1,user_data['total_questions'])*100):.1f}%
+🏆 <b>Your Progress:</b>
+• Level {level} 🎆 ({xp} XP)
+• Study Streak: {study_streak} days 🔥
+• Questions Answered: {total_questions}
+• Accuracy: {accuracy:.1f}%
 
-🚀 **Choose what you'd like to do:**
+🚀 <b>Choose what you'd like to do:</b>
         """
-        
-        # Create interactive keyboard
-        keyboard = [
-            [
-                InlineKeyboardButton("📝 Ask Question", callback_data="ask_question"),
-                InlineKeyboardButton("🧠 Generate Quiz", callback_data="generate_quiz")
-            ],
-            [
-                InlineKeyboardButton("📊 My Progress", callback_data="show_progress"),
-                InlineKeyboardButton("🏆 Achievements", callback_data="achievements")
-            ],
-            [
-                InlineKeyboardButton("📋 Flashcards", callback_data="flashcards"),
-                InlineKeyboardButton("⚙️ Settings", callback_data="settings")
-            ],
-            [
-                InlineKeyboardButton("📚 Study Subjects", callback_data="subjects"),
-                InlineKeyboardButton("📈 Analytics", callback_data="analytics")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(welcome_message, reply_markup=reply_markup, parse_mode='Markdown')
 
-    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Send advanced help with interactive buttons."""
-        help_text = """
-📢 **StudySage Pro Help** 💡
-
-📝 **Commands:**
-• `/start` - Main dashboard
-• `/quiz` - Generate instant quiz
-• `/progress` - View your stats
-• `/remind` - Set study reminders
-• `/subjects` - Manage subjects
-• `/help` - This help menu
-
-📱 **What I can analyze:**
+_DASHBOARD_TEXT: Final = """
+🎓 <b>StudySage Pro Dashboard</b> 🤖✨
+
+Welcome back, {user_name}! 🚀
+
+🏆 <b>Your Progress:</b>
+• Level {level} 🎆 ({xp} XP)
+• Study Streak: {study_streak} days 🔥
+• Questions Answered: {total_questions}
+• Accuracy: {accuracy:.1f}%
+
+🚀 <b>What would you like to do?</b>
+        """
+
+_QUIZ_COMMAND_TEXT: Final = "🧠 <b>Quick Quiz Access</b> 🎯\n\n🏆 Level {level} Student\n\nReady to test your knowledge?"
+
+_PROGRESS_COMMAND_TEXT: Final = """
+📈 <b>Quick Progress Check</b> 🏆
+
+🎆 Level: {level}/10 (⚡ {xp} XP)
+🔥 Study Streak: {study_streak} days
+🎯 Accuracy: {accuracy:.1f}% ({correct_answers}/{total_questions})
+📚 Subjects: {subject_count}
+        """
+
+_SUBJECTS_COMMAND_TEXT: Final = """
+📚 <b>Subject Quick Access</b> 🎨
+
+🏆 Your studied subjects ({subject_count}):
+{subject_list}
+
+🚀 What would you like to do?
+        """
+
+_HELP_TEXT: Final = """
+📢 <b>StudySage Pro Help</b> 💡
+
+📝 <b>Commands:</b>
+• <code>/start</code> - Main dashboard
+• <code>/quiz</code> - Generate instant quiz
+• <code>/progress</code> - View your stats
+• <code>/remind</code> - Set study reminders
+• <code>/subjects</code> - Manage subjects
+• <code>/help</code> - This help menu
+
+📱 <b>What I can analyze:</b>
 • 📝 Text questions (any subject)
 • 📸 Photos (math, diagrams, notes)
 • 🎥 Videos (lectures, demos)
 • 🎙️ Voice messages (transcription)
 
-🎮 **Gamification Features:**
+🎮 <b>Gamification Features:</b>
 • XP points for every question
 • 10 levels to unlock
 • Study streak tracking
 • Achievement badges
 • Progress analytics
 
-🚀 **Quick Tips:**
+🚀 <b>Quick Tips:</b>
 • Ask specific questions for better answers
 • Upload images for visual problem solving
 • Use voice messages for hands-free help
@@ -159,150 +158,688 @@ class StudySageBot:
 
 💬 Need specific help with any feature?
         """
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("🚀 Try a Quiz Now", callback_data="generate_quiz"),
-                InlineKeyboardButton("📊 My Dashboard", callback_data="dashboard")
-            ],
-            [
-                InlineKeyboardButton("📱 Feature Guide", callback_data="feature_guide"),
-                InlineKeyboardButton("🎯 Practice Mode", callback_data="practice_mode")
-            ]
+
+_CLEAR_CONFIRM_TEXT: Final = "🔄 <b>Clear conversation context?</b>\n\nThis will reset our current conversation but keep your progress data."
+_CLEAR_DONE_TEXT: Final = "🔄 <b>Context cleared!</b> Starting fresh. Use /start to return to the main menu."
+_CLEAR_CANCELLED_TEXT: Final = "❌ <b>Cancelled.</b> Your conversation context remains intact."
+_AI_UNAVAILABLE_TEXT: Final = "❌ AI service is not available. Please check the configuration."
+_UPCOMING_ACHIEVEMENTS_TEXT: Final = """
+🚯 <b>Upcoming Achievements:</b>
+• 💯 Perfect Score (100% accuracy in 5 quizzes)
+• 🚀 Knowledge Seeker (Level 10)
+• 🏅 Subject Expert (Master 5 subjects)
+• 🔥 Fire Streak (7-day study streak)
+
+💪 Keep studying to unlock more badges!"""
+_SUBJECT_CATEGORIES_TEXT: Final = """
+🚀 <b>Available Categories:</b>
+• Mathematics &amp; Algebra
+• Science &amp; Physics
+• Literature &amp; Languages
+• History &amp; Geography
+• Computer Science
+• Arts &amp; Philosophy
+
+💡 Start asking questions to track your subjects!"""
+_ASK_QUESTION_TEXT: Final = "📝 <b>Ask me anything!</b>\n\n🚀 Send me:\n• Text questions\n• 📸 Photos of problems\n• 🎥 Educational videos\n• 🎙️ Voice messages\n\nI'll analyze and help you understand!"
+_VOICE_HEADER: Final = "🎙️ Voice Message Processed:\n\n"
+_UNEXPECTED_ERROR_TEXT: Final = "❌ An unexpected error occurred. Please try again later."
+
+# Gemini prompt templates, filled with str.format_map per request. None of them name
+# the student, so answers can be cached and shared
+_MESSAGE_PROMPT: Final = """
+You are StudySage, an intelligent and helpful study assistant. A student has asked you: "{user_message}"
+
+Please provide a clear, educational, and helpful response. Follow these guidelines:
+- Be encouraging and supportive
+- Explain concepts clearly and step-by-step when needed
+- Provide examples where helpful
+- If it's a homework question, guide them through the thinking process rather than just giving the answer
+- Use appropriate emojis to make the response engaging
+- Keep responses concise but comprehensive
+- If the question is unclear, ask for clarification
+
+Student's question: {user_message}
+"""
+
+_MERGE_PROMPT: Final = "Combine and refine these partial answers to: {user_message}\n\n{partial_answers}"
+
+_PHOTO_PROMPT: Final = """
+You are StudySage, an intelligent study assistant. A student has shared an image with you.
+
+Student's message: "{caption}"
+
+Please analyze this image and provide educational assistance. Follow these guidelines:
+- If it's a math problem, guide them through the solution step-by-step
+- If it's a diagram, explain what it shows and its educational significance
+- If it's handwritten notes, help clarify or expand on the content
+- If it's a scientific illustration, explain the concepts shown
+- Be encouraging and educational in your response
+- Use appropriate emojis to make the response engaging
+- If you can't clearly see the content, ask for clarification
+
+Please analyze the image and provide helpful educational assistance.
+"""
+
+_VIDEO_PROMPT: Final = """
+You are StudySage, an intelligent study assistant. A student has shared a video with you.
+
+Student's message: "{caption}"
+
+Please analyze this video and provide educational assistance. Follow these guidelines:
+- If it's an educational video, summarize the key concepts
+- If it contains audio, provide transcription when helpful
+- If it shows a demonstration or experiment, explain what's happening
+- If it's a lecture recording, highlight the main points
+- Provide timestamps for important moments when relevant
+- Be encouraging and educational in your response
+- Use appropriate emojis to make the response engaging
+- If the video is unclear or too long, ask for clarification
+
+Please analyze the video content and provide helpful educational assistance.
+"""
+
+_VOICE_PROMPT: Final = """
+You are StudySage, an intelligent study assistant. A student has sent you a voice message.
+
+Please:
+1. Transcribe the audio accurately
+2. Understand the educational question or topic
+3. Provide a helpful response to their study question
+4. If it's a complex topic, break it down step-by-step
+5. Be encouraging and educational
+
+Transcribe and respond to this voice message:
+"""
+
+_QUIZ_PROMPT: Final = """
+Generate a {difficulty} difficulty {subject} quiz question suitable for a Level {level} student.
+
+Format your response EXACTLY like this:
+**Question:** [Your question here]
+
+**A)** [Option A]
+**B)** [Option B] 
+**C)** [Option C]
+**D)** [Option D]
+
+**Correct Answer:** [A, B, C, or D]
+**Explanation:** [Brief explanation why this is correct]
+
+Make it educational and engaging!
+"""
+
+# Inline keyboards never change, so each markup is built once at import and shared
+_MAIN_MENU_MARKUP: Final = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📝 Ask Question", callback_data="ask_question"),
+        InlineKeyboardButton("🧠 Generate Quiz", callback_data="generate_quiz")
+    ],
+    [
+        InlineKeyboardButton("📊 My Progress", callback_data="show_progress"),
+        InlineKeyboardButton("🏆 Achievements", callback_data="achievements")
+    ],
+    [
+        InlineKeyboardButton("📋 Flashcards", callback_data="flashcards"),
+        InlineKeyboardButton("⚙️ Settings", callback_data="settings")
+    ],
+    [
+        InlineKeyboardButton("📚 Study Subjects", callback_data="subjects"),
+        InlineKeyboardButton("📈 Analytics", callback_data="analytics")
+    ]
+])
+_HELP_MARKUP: Final = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🚀 Try a Quiz Now", callback_data="generate_quiz"),
+        InlineKeyboardButton("📊 My Dashboard", callback_data="dashboard")
+    ],
+    [
+        InlineKeyboardButton("📱 Feature Guide", callback_data="feature_guide"),
+        InlineKeyboardButton("🎯 Practice Mode", callback_data="practice_mode")
+    ]
+])
+_CLEAR_CONFIRM_MARKUP: Final = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ Yes, Clear", callback_data="confirm_clear"),
+        InlineKeyboardButton("❌ Cancel", callback_data="cancel_clear")
+    ]
+])
+_PROGRESS_MARKUP: Final = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📈 Detailed Analytics", callback_data="analytics"),
+        InlineKeyboardButton("🏆 Achievements", callback_data="achievements")
+    ],
+    [InlineKeyboardButton("🔙 Back to Main", callback_data="dashboard")]
+])
+_ACHIEVEMENTS_MARKUP: Final = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Progress", callback_data="show_progress")]])
+_FLASHCARDS_MARKUP: Final = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📝 Create from Text", callback_data="flashcard_text"),
+        InlineKeyboardButton("📸 Create from Image", callback_data="flashcard_image")
+    ],
+    [InlineKeyboardButton("🔙 Back to Main", callback_data="dashboard")]
+])
+_SETTINGS_MARKUP: Final = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🎯 Set Difficulty", callback_data="set_difficulty"),
+        InlineKeyboardButton("⏰ Study Reminders", callback_data="set_reminders")
+    ],
+    [
+        InlineKeyboardButton("📚 Favorite Subjects", callback_data="set_subjects"),
+        InlineKeyboardButton("🎨 Personalization", callback_data="personalize")
+    ],
+    [InlineKeyboardButton("🔙 Back to Main", callback_data="dashboard")]
+])
+_SUBJECTS_MARKUP: Final = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🧠 Generate Subject Quiz", callback_data="generate_quiz"),
+        InlineKeyboardButton("📈 Subject Analytics", callback_data="analytics")
+    ],
+    [InlineKeyboardButton("🔙 Back to Main", callback_data="dashboard")]
+])
+_ANALYTICS_MARKUP: Final = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📧 Export Data", callback_data="export_data"),
+        InlineKeyboardButton("🔄 Reset Stats", callback_data="reset_stats")
+    ],
+    [InlineKeyboardButton("🔙 Back to Progress", callback_data="show_progress")]
+])
+_QUIZ_ANSWER_MARKUP: Final = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🅰️ A", callback_data="quiz_answer_A"),
+        InlineKeyboardButton("🅱️ B", callback_data="quiz_answer_B")
+    ],
+    [
+        InlineKeyboardButton("🄲️ C", callback_data="quiz_answer_C"),
+        InlineKeyboardButton("🄳️ D", callback_data="quiz_answer_D")
+    ],
+    [
+        InlineKeyboardButton("🔄 New Question", callback_data="generate_quiz"),
+        InlineKeyboardButton("🔙 Main Menu", callback_data="dashboard")
+    ]
+])
+_QUIZ_COMMAND_MARKUP: Final = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🧠 Start Quiz", callback_data="generate_quiz"),
+        InlineKeyboardButton("📈 My Progress", callback_data="show_progress")
+    ],
+    [
+        InlineKeyboardButton("🎯 Practice Mode", callback_data="practice_mode"),
+        InlineKeyboardButton("📚 Study Subjects", callback_data="subjects")
+    ]
+])
+_PROGRESS_COMMAND_MARKUP: Final = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📈 Detailed Stats", callback_data="analytics"),
+        InlineKeyboardButton("🏆 Achievements", callback_data="achievements")
+    ],
+    [InlineKeyboardButton("🚀 Dashboard", callback_data="dashboard")]
+])
+_SUBJECTS_COMMAND_MARKUP: Final = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🧠 Subject Quiz", callback_data="generate_quiz"),
+        InlineKeyboardButton("📋 Subject Analytics", callback_data="analytics")
+    ],
+    [
+        InlineKeyboardButton("📝 Ask Question", callback_data="ask_question"),
+        InlineKeyboardButton("🚀 Dashboard", callback_data="dashboard")
+    ]
+])
+_QUIZ_SUBJECT_MARKUP: Final = InlineKeyboardMarkup([
+    *(
+        [
+            InlineKeyboardButton(f"📚 {subject}", callback_data=f"quiz_subject_{subject.lower()}")
+            for subject in SUBJECTS[i:i + 2]
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        for i in range(0, len(SUBJECTS), 2)
+    ),
+    [InlineKeyboardButton("🎲 Random Topic", callback_data="quiz_subject_random")]
+])
+
+# Badges as (stat getter, threshold, label), in display order
+_ACHIEVEMENTS: Final = (
+    (operator.attrgetter('total_questions'), 10, "🎆 Curious Learner (10+ questions)"),
+    (operator.attrgetter('total_questions'), 50, "🏆 Quiz Master (50+ questions)"),
+    (operator.attrgetter('study_streak'), 3, "🔥 Study Streak (3+ days)"),
+    (operator.attrgetter('level'), 3, "⭐ Rising Star (Level 3+)"),
+    (operator.attrgetter('level'), 5, "🌟 Study Expert (Level 5+)"),
+    (lambda state: state.subjects_studied.bit_count(), 3, "📚 Multi-Subject Scholar"),
+)
+
+
+@functools.lru_cache(maxsize=None)
+def render_achievements(unlocked: int) -> str:
+    """Render the achievements screen for a bitmask of unlocked _ACHIEVEMENTS entries."""
+    lines = ["🏆 <b>Your Achievements</b> 🎆", "", "✨ <b>Unlocked Badges:</b>"]
+    lines.extend(label for bit, (_, _, label) in enumerate(_ACHIEVEMENTS) if unlocked >> bit & 1)
+    if not unlocked:
+        lines.append("❌ No achievements yet - keep studying!")
+    lines.append(_UPCOMING_ACHIEVEMENTS_TEXT)
+    return "\n".join(lines)
+
+
+_BOLD_MARKDOWN: Final = re.compile(r"\*\*(.+?)\*\*")
+
+
+def markdown_to_html(text: str) -> str:
+    """Escape Gemini output for HTML parse mode, keeping its **bold** spans as <b> tags."""
+    return _BOLD_MARKDOWN.sub(r"<b>\1</b>", html.escape(text, quote=False))
+
+
+def find_break(text: str, start: int, end: int) -> Tuple[int, int]:
+    """Pick where a chunk of text[start:end] should end and where the next chunk begins."""
+    # Prefer ending on a paragraph boundary so Markdown and code blocks stay intact,
+    # then on a sentence end, a line end or a space; only split mid-word when there
+    # is none of these
+    cut = text.rfind("\n\n", start, end)
+    if cut > start:
+        return cut, cut + 2
+    cut = text.rfind(". ", start, end)
+    if cut > start:
+        return cut + 1, cut + 2
+    for separator in ("\n", " "):
+        cut = text.rfind(separator, start, end)
+        if cut > start:
+            return cut, cut + 1
+    return end, end
+
+
+def iter_message_chunks(text: str, limit: int = 4000) -> Iterator[str]:
+    """Yield pieces of text that fit in one Telegram message, splitting at natural breaks where possible."""
+    start = 0
+    while start < len(text):
+        end = start + limit
+        next_start = end
+        if end < len(text):
+            end, next_start = find_break(text, start, end)
+        yield text[start:end]
+        start = next_start
+
+
+class OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Bot API responses with orjson."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # Invalid UTF-8 or JSON: let PTB decode leniently and raise its usual error
+            return HTTPXRequest.parse_json_payload(payload)
+
+
+def _semaphore_for(registry: "weakref.WeakValueDictionary[int, asyncio.Semaphore]", key: int,
+                   limit: int) -> asyncio.Semaphore:
+    """Get or create the semaphore for key; it is dropped from registry once nothing holds it."""
+    semaphore = registry.get(key)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(limit)
+        registry[key] = semaphore
+    return semaphore
+
+
+class StudySageBot:
+    # Fixed attribute layout: no per-instance __dict__
+    __slots__ = (
+        'user_store', 'response_cache', 'semantic_cache', 'quiz_pool',
+        '_user_slots', '_chat_locks', '_quiz_refills', '_pending_answers', '_background_tasks',
+        '_callbacks', '_callback_prefixes'
+    )
+    
+    # AI requests a single user may have in flight, so one student can't crowd out others
+    max_requests_per_user: Final[int] = 2
+    # Minimum seconds between edits of a message that is still being streamed, to stay
+    # inside Telegram's edit rate limits
+    stream_edit_interval: Final[float] = 1.0
+    # Quiz pools are refilled with quiz_pool_batch questions once they drop below quiz_pool_low
+    quiz_pool_low: Final[int] = 5
+    quiz_pool_batch: Final[int] = 5
+    
+    def __init__(self):
+        # Student progress, kept on disk so restarts don't wipe it
+        self.user_store = UserStore(USER_DB_PATH)
+        # Answers to repeated text questions, shared across users and restarts
+        self.response_cache = ResponseCache(CACHE_PATH)
+        # Answers to paraphrased questions, namespaced per chat
+        self.semantic_cache = SemanticCache(CACHE_PATH)
+        # Per-user request semaphores; entries disappear once no request holds them
+        self._user_slots: "weakref.WeakValueDictionary[int, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+        # Per-chat send locks, so multi-message answers in one chat never interleave
+        self._chat_locks: "weakref.WeakValueDictionary[int, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+        # Ready-made quiz questions, and the background refills currently running
+        self.quiz_pool = QuizPool(CACHE_PATH)
+        self._quiz_refills: Dict[tuple, asyncio.Task] = {}
+        # Cache key -> answer of a text question currently being generated, so identical
+        # questions arriving meanwhile wait for it instead of calling Gemini again
+        self._pending_answers: Dict[str, asyncio.Future] = {}
+        # Fire-and-forget tasks, referenced here so they aren't garbage collected mid-run
+        self._background_tasks: Set[asyncio.Task] = set()
+        # Inline button callback data -> handler taking (query, user_data)
+        self._callbacks = {
+            "ask_question": self.ask_question,
+            "generate_quiz": self.generate_quiz,
+            "show_progress": self.show_progress,
+            "achievements": self.show_achievements,
+            "flashcards": self.show_flashcards,
+            "settings": self.show_settings,
+            "subjects": self.show_subjects,
+            "analytics": self.show_analytics,
+            "dashboard": self.show_dashboard,
+            "confirm_clear": self.confirm_clear,
+            "cancel_clear": self.cancel_clear
+        }
+        self._callback_prefixes = {
+            "quiz": self.handle_quiz_answer,
+            "difficulty": self.set_difficulty
+        }
+        
+    def per_user(self, handler):
+        """Wrap an AI handler so each user has at most max_requests_per_user requests running."""
+        @functools.wraps(handler)
+        async def limited(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            semaphore = _semaphore_for(self._user_slots, update.effective_user.id, self.max_requests_per_user)
+            async with semaphore:
+                await handler(update, context)
+        return limited
+        
+    def chat_lock(self, chat_id: int) -> asyncio.Semaphore:
+        """Return the lock that keeps sends to one chat in order."""
+        return _semaphore_for(self._chat_locks, chat_id, 1)
+        
+    async def get_user_data(self, user_id: int) -> UserState:
+        """Get or create user data."""
+        # Profile reads and writes are SQLite I/O, so they run in worker threads
+        # instead of on the event loop
+        data = await asyncio.to_thread(self.user_store.get, user_id)
+        if data is None:
+            data = UserState()
+            await asyncio.to_thread(self.user_store.save, user_id, data)
+        return data
+        
+    async def update_user_stats(self, user_id: int, subject: str = None, correct: bool = None):
+        """Update user statistics and XP."""
+        data = await self.get_user_data(user_id)
+        data.last_activity = time.time()
+        
+        if subject:
+            data.subjects_studied |= SUBJECT_BITS.get(subject, 0)
+            
+        if correct is not None:
+            data.total_questions += 1
+            if correct:
+                data.correct_answers += 1
+                data.xp += 10
+            else:
+                data.xp += 2
+            data.accuracy = data.correct_answers * 100 / data.total_questions
+                
+        # Level up system
+        new_level = min(10, data.xp // 100 + 1)
+        leveled_up = new_level > data.level
+        if leveled_up:
+            data.level = new_level
+            
+        await asyncio.to_thread(self.user_store.save, user_id, data)
+        return leveled_up
+        
+    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Send a message when the command /start is issued."""
+        user_id = update.effective_user.id
+        user_data = await self.get_user_data(user_id)
+        user_name = update.effective_user.first_name or "Student"
         
-        await update.message.reply_text(help_text, reply_markup=reply_markup, parse_mode='Markdown')
+        welcome_message = _WELCOME_MESSAGE.format(
+            user_name=html.escape(user_name),
+            level=user_data.level,
+            xp=user_data.xp,
+            study_streak=user_data.study_streak,
+            total_questions=user_data.total_questions,
+            accuracy=user_data.accuracy
+        )
+        
+        await update.message.reply_text(welcome_message, reply_markup=_MAIN_MENU_MARKUP, parse_mode=ParseMode.HTML)
+
+    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Send advanced help with interactive buttons."""
+        await update.message.reply_text(_HELP_TEXT, reply_markup=_HELP_MARKUP, parse_mode=ParseMode.HTML)
 
     async def clear_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Clear conversation context with confirmation."""
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Yes, Clear", callback_data="confirm_clear"),
-                InlineKeyboardButton("❌ Cancel", callback_data="cancel_clear")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await update.message.reply_text(
-            "🔄 **Clear conversation context?**\n\nThis will reset our current conversation but keep your progress data.",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
+            _CLEAR_CONFIRM_TEXT,
+            reply_markup=_CLEAR_CONFIRM_MARKUP,
+            parse_mode=ParseMode.HTML
         )
         
-    async def download_file(self, file_id: str, context: ContextTypes.DEFAULT_TYPE) -> str:
-        """Download a file from Telegram and return the local file path."""
+    async def send_typing(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Show the typing indicator; meant to run as a background task, so failures are only logged."""
+        try:
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
+        except Exception as e:
+            logger.warning("Error sending typing indicator: %s", e)
+            
+    async def reply_long_text(self, message, text: str, **kwargs) -> None:
+        """Reply with text, splitting it to stay under Telegram's message size limit."""
+        reply = message.reply_text
+        async with self.chat_lock(message.chat_id):
+            for chunk in iter_message_chunks(text):
+                await reply(chunk, **kwargs)
+            
+    async def stream_reply(self, message, contents, header: str = "") -> str:
+        """Stream a Gemini response into the chat, growing the reply in place as it is generated.
+        
+        The reply is sent on the first text and edited as more arrives; once it nears
+        Telegram's size limit it is finished and a new message started. Returns the full
+        response text (without header), or an empty string if Gemini produced nothing.
+        """
+        parts = []
+        append_part = parts.append
+        reply = message.reply_text
+        loop = asyncio.get_running_loop()
+        buffer = header
+        # The message currently being grown, the text it shows, and when it last changed
+        sent, shown, last_edit = None, "", 0.0
+        # Final edits of finished messages; they can't reorder anything, so they run
+        # alongside the send of the next message instead of before it
+        finishing = []
+        stream = await genai_client.aio.models.generate_content_stream(model=MODEL_NAME, contents=contents)
+        # Generation starts before taking the chat lock; only the sends wait for an
+        # earlier answer in the same chat to finish
+        async with self.chat_lock(message.chat_id):
+            try:
+                async for chunk in stream:
+                    piece = chunk.text
+                    if not piece:
+                        continue
+                    append_part(piece)
+                    buffer += piece
+                    # Finish full blocks while Gemini keeps decoding, at natural breaks and
+                    # under Telegram's 4096 character limit
+                    while len(buffer) >= 3800:
+                        cut, resume = find_break(buffer, 0, 3800)
+                        block = buffer[:cut].strip()
+                        if sent is None:
+                            await reply(block)
+                        elif block != shown:
+                            finishing.append(asyncio.create_task(sent.edit_text(block)))
+                        sent, shown = None, ""
+                        buffer = buffer[resume:].lstrip("\n")
+                    
+                    # Whitespace-only pieces leave the text unchanged, and Telegram rejects
+                    # an edit that doesn't modify the message
+                    text = buffer.strip()
+                    if text and text != shown and loop.time() - last_edit >= self.stream_edit_interval:
+                        if sent is None:
+                            sent = await reply(text)
+                        else:
+                            await sent.edit_text(text)
+                        shown, last_edit = text, loop.time()
+                
+                # With no response at all the buffer holds only the header, which isn't
+                # worth a message of its own
+                text = buffer.strip()
+                if parts and text and text != shown:
+                    if sent is None:
+                        await reply(text)
+                    else:
+                        await sent.edit_text(text)
+            finally:
+                # Finishing edits only tidy messages whose text was already sent, so a
+                # failed one is logged rather than failing an answer that was delivered.
+                # Awaited on every path, so none is left running after an error
+                for result in await asyncio.gather(*finishing, return_exceptions=True):
+                    if isinstance(result, Exception):
+                        logger.warning("Error finishing a streamed message: %s", result)
+        return "".join(parts).strip()
+        
+    async def embed_text(self, text: str) -> Optional[List[float]]:
+        """Embed text for the semantic cache; returns None if embedding fails."""
+        try:
+            result = await genai_client.aio.models.embed_content(
+                model=EMBEDDING_MODEL_NAME,
+                contents=text,
+                config=types.EmbedContentConfig(output_dimensionality=EMBEDDING_DIMENSIONS)
+            )
+            return result.embeddings[0].values
+        except (errors.APIError, httpx.HTTPError) as e:
+            logger.warning("Error embedding prompt, skipping semantic cache: %s", e)
+            return None
+            
+    async def remember_answer(self, namespace: str, prompt: str, answer: str,
+                              embedding: Optional[List[float]] = None) -> None:
+        """Store an answer in the semantic cache, embedding its prompt first if that wasn't done yet."""
+        try:
+            embedding = embedding or await self.embed_text(prompt)
+            if embedding:
+                await asyncio.to_thread(self.semantic_cache.store, namespace, embedding, answer)
+        except Exception as e:
+            # Runs as a background task, so errors are logged instead of raised
+            logger.warning("Error storing answer in the semantic cache: %s", e)
+            
+    @staticmethod
+    def content_digest(data: bytes) -> str:
+        """Return a BLAKE2b hex digest of downloaded file contents."""
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+        
+    async def upload_media(self, data: bytes, digest: str, mime_type: str):
+        """Upload media to the Gemini Files API, reusing an earlier upload of identical bytes."""
+        # Uploaded files live for 48 hours, longer than the response cache TTL
+        upload_key = make_cache_key('gemini_upload', digest)
+        file_uri = await asyncio.to_thread(self.response_cache.get, upload_key)
+        if file_uri:
+            return types.Part.from_uri(file_uri=file_uri, mime_type=mime_type)
+            
+        uploaded_file = await genai_client.aio.files.upload(
+            file=io.BytesIO(data),
+            config={'mime_type': mime_type}
+        )
+        await asyncio.to_thread(self.response_cache.set, upload_key, uploaded_file.uri)
+        return uploaded_file
+            
+    async def delete_upload(self, name: str) -> None:
+        """Delete a one-off Gemini upload, logging rather than raising if that fails."""
+        try:
+            await genai_client.aio.files.delete(name=name)
+        except (errors.APIError, httpx.HTTPError) as e:
+            logger.warning("Could not delete Gemini file %s: %s", name, e)
+            
+    async def post_init(self, application) -> None:
+        """Open the Gemini connection at startup so the first question skips the TLS handshake."""
+        if not genai_client:
+            return
+        try:
+            await genai_client.aio.models.get(model=MODEL_NAME)
+        except (errors.APIError, httpx.HTTPError) as e:
+            logger.warning("Could not warm up the Gemini connection: %s", e)
+            
+    async def post_shutdown(self, application) -> None:
+        """Save the quiz pool and delete Gemini uploads left behind by interrupted handlers."""
+        self.quiz_pool.save()
+        pending_uploads = application.bot_data.pop('gemini_uploads', set())
+        if pending_uploads:
+            await asyncio.gather(*(self.delete_upload(name) for name in pending_uploads))
+            
+    async def download_file(self, file_id: str, context: ContextTypes.DEFAULT_TYPE) -> bytes:
+        """Download a file from Telegram straight into memory and return its contents."""
         try:
             # Get file from Telegram
             telegram_file = await context.bot.get_file(file_id)
             
-            # Create temporary file
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.tmp')
-            temp_file_path = temp_file.name
-            temp_file.close()
-            
-            # Download file
-            await telegram_file.download_to_drive(temp_file_path)
+            # Download into memory, skipping the temp file write/read/unlink round trip
+            buffer = io.BytesIO()
+            await telegram_file.download_to_memory(buffer)
             
-            logger.info(f"Downloaded file to {temp_file_path}")
-            return temp_file_path
+            logger.info("Downloaded %d bytes for file %s", buffer.tell(), file_id)
+            return buffer.getvalue()
             
         except Exception as e:
-            logger.error(f"Error downloading file: {e}")
+            logger.error("Error downloading file: %s", e)
             raise
             
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle photo messages and analyze them with AI."""
-        if not genai_client:
-            await update.message.reply_text(
-                "❌ AI service is not available. Please check the configuration."
-            )
-            return
-
         user_name = update.effective_user.first_name or "Student"
-        logger.info(f"User {user_name} sent a photo")
-        
-        # Show typing indicator
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
+        logger.info("User %s sent a photo", user_name)
         
         try:
             # Get the largest photo size
             photo = update.message.photo[-1]
             
-            # Download the photo
-            photo_path = await self.download_file(photo.file_id, context)
-            
             # Get caption if provided
             caption = update.message.caption or "Analyze this image"
             
-            # Upload to Gemini
-            image_file = genai_client.files.upload(file=photo_path)
-            
-            # Create enhanced prompt for image analysis
-            enhanced_prompt = f"""
-You are StudySage, an intelligent study assistant. A student named {user_name} has shared an image with you.
-
-Student's message: "{caption}"
-
-Please analyze this image and provide educational assistance. Follow these guidelines:
-- If it's a math problem, guide them through the solution step-by-step
-- If it's a diagram, explain what it shows and its educational significance
-- If it's handwritten notes, help clarify or expand on the content
-- If it's a scientific illustration, explain the concepts shown
-- Be encouraging and educational in your response
-- Use appropriate emojis to make the response engaging
-- If you can't clearly see the content, ask for clarification
-
-Please analyze the image and provide helpful educational assistance.
-            """
+            # Create enhanced prompt for image analysis (name-free so the answer can be shared)
+            enhanced_prompt = _PHOTO_PROMPT.format_map({'caption': caption})
             
-            # Generate response using Gemini vision
-            response = genai_client.models.generate_content(
-                model=self.model,
-                contents=[enhanced_prompt, image_file]
+            # Download the photo and embed the caption while the typing indicator is being sent
+            typing_task = asyncio.create_task(self.send_typing(update, context))
+            photo_data, embedding, _ = await asyncio.gather(
+                self.download_file(photo.file_id, context),
+                self.embed_text(normalize_prompt(caption)),
+                typing_task
             )
             
-            if response and response.text:
-                # Split long messages to avoid Telegram's character limit
-                ai_response = response.text.strip()
-                if len(ai_response) > 4000:
-                    chunks = [ai_response[i:i+4000] for i in range(0, len(ai_response), 4000)]
-                    for chunk in chunks:
-                        await update.message.reply_text(chunk)
-                else:
-                    await update.message.reply_text(ai_response)
+            # Serve a cached analysis of the same image: first for the exact caption,
+            # then for a similarly worded one
+            chat_key = make_cache_key(EMBEDDING_MODEL_NAME, str(update.effective_chat.id))
+            photo_digest = await asyncio.to_thread(self.content_digest, photo_data)
+            cache_key = make_cache_key('photo', MODEL_NAME, photo_digest, normalize_prompt(caption))
+            cached_response = await asyncio.to_thread(self.response_cache.get, cache_key)
+            if not cached_response and embedding:
+                cached_response = await asyncio.to_thread(self.semantic_cache.lookup, chat_key, embedding, photo_digest)
+            if cached_response:
+                await self.reply_long_text(update.message, cached_response)
+                logger.info("Cached AI image analysis sent to %s", user_name)
+                return
+            
+            # Telegram photos are well under Gemini's inline request limit, so send the
+            # bytes with the prompt instead of a separate Files API upload round trip
+            image_file = types.Part.from_bytes(data=photo_data, mime_type='image/jpeg')
+            
+            # Stream the Gemini vision response to the chat as it is generated
+            ai_response = await self.stream_reply(update.message, [enhanced_prompt, image_file])
+            
+            if ai_response:
+                await asyncio.to_thread(self.response_cache.set, cache_key, ai_response)
+                if embedding:
+                    await asyncio.to_thread(self.semantic_cache.store, chat_key, embedding, ai_response, photo_digest)
                     
-                logger.info(f"AI image analysis sent to {user_name}")
+                logger.info("AI image analysis sent to %s", user_name)
             else:
                 await update.message.reply_text(
                     "🤔 I'm having trouble analyzing this image right now. Please try again in a moment."
                 )
                 
-            # Clean up temporary file
-            try:
-                os.unlink(photo_path)
-            except:
-                pass
-                
         except Exception as e:
-            logger.error(f"Error processing photo: {e}")
+            logger.error("Error processing photo: %s", e)
             await update.message.reply_text(
                 "⚠️ Sorry, I encountered an error while analyzing your image. Please try again."
             )
             
     async def handle_video(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle video messages and analyze them with AI."""
-        if not genai_client:
-            await update.message.reply_text(
-                "❌ AI service is not available. Please check the configuration."
-            )
-            return
-
         user_name = update.effective_user.first_name or "Student"
-        logger.info(f"User {user_name} sent a video")
-        
-        # Show typing indicator
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
+        logger.info("User %s sent a video", user_name)
         
         try:
             # Get video file
@@ -315,138 +852,115 @@ Please analyze the image and provide helpful educational assistance.
                 )
                 return
             
-            # Download the video
-            video_path = await self.download_file(video.file_id, context)
-            
             # Get caption if provided
             caption = update.message.caption or "Analyze this video"
             
-            # Upload to Gemini
-            video_file = genai_client.files.upload(file=video_path)
+            # Create enhanced prompt for video analysis (name-free so the answer can be shared)
+            enhanced_prompt = _VIDEO_PROMPT.format_map({'caption': caption})
             
-            # Create enhanced prompt for video analysis
-            enhanced_prompt = f"""
-You are StudySage, an intelligent study assistant. A student named {user_name} has shared a video with you.
-
-Student's message: "{caption}"
-
-Please analyze this video and provide educational assistance. Follow these guidelines:
-- If it's an educational video, summarize the key concepts
-- If it contains audio, provide transcription when helpful
-- If it shows a demonstration or experiment, explain what's happening
-- If it's a lecture recording, highlight the main points
-- Provide timestamps for important moments when relevant
-- Be encouraging and educational in your response
-- Use appropriate emojis to make the response engaging
-- If the video is unclear or too long, ask for clarification
-
-Please analyze the video content and provide helpful educational assistance.
-            """
-            
-            # Generate response using Gemini multimodal
-            response = genai_client.models.generate_content(
-                model=self.model,
-                contents=[enhanced_prompt, video_file]
+            # Download the video and embed the caption while the typing indicator is being sent
+            typing_task = asyncio.create_task(self.send_typing(update, context))
+            video_data, embedding, _ = await asyncio.gather(
+                self.download_file(video.file_id, context),
+                self.embed_text(normalize_prompt(caption)),
+                typing_task
             )
             
-            if response and response.text:
-                # Split long messages to avoid Telegram's character limit
-                ai_response = response.text.strip()
-                if len(ai_response) > 4000:
-                    chunks = [ai_response[i:i+4000] for i in range(0, len(ai_response), 4000)]
-                    for chunk in chunks:
-                        await update.message.reply_text(chunk)
-                else:
-                    await update.message.reply_text(ai_response)
+            # Serve a cached analysis of the same video: first for the exact caption,
+            # then for a similarly worded one
+            chat_key = make_cache_key(EMBEDDING_MODEL_NAME, str(update.effective_chat.id))
+            video_digest = await asyncio.to_thread(self.content_digest, video_data)
+            cache_key = make_cache_key('video', MODEL_NAME, video_digest, normalize_prompt(caption))
+            cached_response = await asyncio.to_thread(self.response_cache.get, cache_key)
+            if not cached_response and embedding:
+                cached_response = await asyncio.to_thread(self.semantic_cache.lookup, chat_key, embedding, video_digest)
+            if cached_response:
+                await self.reply_long_text(update.message, cached_response)
+                logger.info("Cached AI video analysis sent to %s", user_name)
+                return
+            
+            # Upload to Gemini
+            video_file = await self.upload_media(video_data, video_digest, video.mime_type or 'video/mp4')
+            
+            # Stream the Gemini multimodal response to the chat as it is generated
+            ai_response = await self.stream_reply(update.message, [enhanced_prompt, video_file])
+            
+            if ai_response:
+                await asyncio.to_thread(self.response_cache.set, cache_key, ai_response)
+                if embedding:
+                    await asyncio.to_thread(self.semantic_cache.store, chat_key, embedding, ai_response, video_digest)
                     
-                logger.info(f"AI video analysis sent to {user_name}")
+                logger.info("AI video analysis sent to %s", user_name)
             else:
                 await update.message.reply_text(
                     "🤔 I'm having trouble analyzing this video right now. Please try again in a moment."
                 )
                 
-            # Clean up temporary file
-            try:
-                os.unlink(video_path)
-            except:
-                pass
-                
         except Exception as e:
-            logger.error(f"Error processing video: {e}")
+            logger.error("Error processing video: %s", e)
             await update.message.reply_text(
                 "⚠️ Sorry, I encountered an error while analyzing your video. Please try again."
             )
             
     async def handle_voice(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle voice messages and transcribe them."""
-        if not genai_client:
-            await update.message.reply_text(
-                "❌ AI service is not available. Please check the configuration."
-            )
-            return
-
         user_name = update.effective_user.first_name or "Student"
-        logger.info(f"User {user_name} sent a voice message")
-        
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
+        logger.info("User %s sent a voice message", user_name)
         
+        # Voice uploads are single use, so they are deleted once answered; the registry
+        # lets post_shutdown clean up any a cancelled handler never got to
+        audio_file = None
+        pending_uploads = context.bot_data.setdefault('gemini_uploads', set())
         try:
-            # Download voice message
-            voice_path = await self.download_file(update.message.voice.file_id, context)
+            # Download voice message while the typing indicator is being sent
+            voice = update.message.voice
+            typing_task = asyncio.create_task(self.send_typing(update, context))
+            voice_data, _ = await asyncio.gather(self.download_file(voice.file_id, context), typing_task)
             
-            # Upload to Gemini for transcription
-            audio_file = genai_client.files.upload(file=voice_path)
+            # Serve a cached answer to the same recording (e.g. one forwarded again)
+            voice_digest = await asyncio.to_thread(self.content_digest, voice_data)
+            cache_key = make_cache_key('voice', MODEL_NAME, voice_digest)
+            cached_response = await asyncio.to_thread(self.response_cache.get, cache_key)
+            if cached_response:
+                await self.reply_long_text(update.message, f"{_VOICE_HEADER}{cached_response}")
+                await self.update_user_stats(update.effective_user.id)
+                logger.info("Cached AI voice response sent to %s", user_name)
+                return
             
-            # Enhanced prompt for voice transcription
-            enhanced_prompt = f"""
-You are StudySage, an intelligent study assistant. A student named {user_name} has sent you a voice message.
-
-Please:
-1. Transcribe the audio accurately
-2. Understand the educational question or topic
-3. Provide a helpful response to their study question
-4. If it's a complex topic, break it down step-by-step
-5. Be encouraging and educational
-
-Transcribe and respond to this voice message:
-            """
+            # Upload to Gemini for transcription
+            audio_file = await genai_client.aio.files.upload(
+                file=io.BytesIO(voice_data),
+                config={'mime_type': voice.mime_type or 'audio/ogg'}
+            )
+            pending_uploads.add(audio_file.name)
             
-            # Generate response
-            response = genai_client.models.generate_content(
-                model=self.model,
-                contents=[enhanced_prompt, audio_file]
+            # Stream the answer to the chat as it is generated
+            ai_response = await self.stream_reply(
+                update.message,
+                [_VOICE_PROMPT, audio_file],
+                header=_VOICE_HEADER
             )
             
-            if response and response.text:
-                # Add voice icon and format response
-                ai_response = f"🎙️ **Voice Message Processed:**\n\n{response.text.strip()}"
+            if ai_response:
+                await asyncio.to_thread(self.response_cache.set, cache_key, ai_response)
                 
-                if len(ai_response) > 4000:
-                    chunks = [ai_response[i:i+4000] for i in range(0, len(ai_response), 4000)]
-                    for chunk in chunks:
-                        await update.message.reply_text(chunk, parse_mode='Markdown')
-                else:
-                    await update.message.reply_text(ai_response, parse_mode='Markdown')
-                    
                 # Update user stats
-                self.update_user_stats(update.effective_user.id)
-                logger.info(f"AI voice response sent to {user_name}")
+                await self.update_user_stats(update.effective_user.id)
+                logger.info("AI voice response sent to %s", user_name)
             else:
                 await update.message.reply_text(
                     "🤔 I'm having trouble processing your voice message right now. Please try again."
                 )
                 
-            # Clean up
-            try:
-                os.unlink(voice_path)
-            except:
-                pass
-                
         except Exception as e:
-            logger.error(f"Error processing voice: {e}")
+            logger.error("Error processing voice: %s", e)
             await update.message.reply_text(
                 "⚠️ Sorry, I encountered an error while processing your voice message. Please try again."
             )
+        finally:
+            if audio_file:
+                pending_uploads.discard(audio_file.name)
+                await self.delete_upload(audio_file.name)
             
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle all callback queries from inline keyboards."""
@@ -454,273 +968,169 @@ Transcribe and respond to this voice message:
         await query.answer()
         
         user_id = update.effective_user.id
-        user_data = self.get_user_data(user_id)
-        
-        if query.data == "ask_question":
-            await query.edit_message_text(
-                "📝 **Ask me anything!**\n\n🚀 Send me:\n• Text questions\n• 📸 Photos of problems\n• 🎥 Educational videos\n• 🎙️ Voice messages\n\nI'll analyze and help you understand!",
-                parse_mode='Markdown'
-            )
-            
-        elif query.data == "generate_quiz":
-            await self.generate_quiz(query, user_data)
-            
-        elif query.data == "show_progress":
-            await self.show_progress(query, user_data)
-            
-        elif query.data == "achievements":
-            await self.show_achievements(query, user_data)
-            
-        elif query.data == "flashcards":
-            await self.show_flashcards(query, user_data)
-            
-        elif query.data == "settings":
-            await self.show_settings(query, user_data)
-            
-        elif query.data == "subjects":
-            await self.show_subjects(query, user_data)
-            
-        elif query.data == "analytics":
-            await self.show_analytics(query, user_data)
-            
-        elif query.data == "dashboard":
-            # Redirect to start command functionality
-            await self.show_dashboard(query, user_data)
-            
-        elif query.data == "confirm_clear":
-            await query.edit_message_text("🔄 **Context cleared!** Starting fresh. Use /start to return to the main menu.")
-            
-        elif query.data == "cancel_clear":
-            await query.edit_message_text("❌ **Cancelled.** Your conversation context remains intact.")
-            
-        elif query.data.startswith("quiz_"):
-            await self.handle_quiz_answer(query, user_data)
-            
-        elif query.data.startswith("difficulty_"):
-            difficulty = query.data.split("_")[1]
-            user_data['preferences']['difficulty'] = difficulty
-            await query.edit_message_text(f"✅ **Difficulty set to {difficulty.title()}!**\n\nThis will affect future quizzes and recommendations.")
+        user_data = await self.get_user_data(user_id)
+        
+        # One dict lookup on the full callback data, then on its prefix for
+        # parameterised buttons like quiz_subject_math and difficulty_hard
+        data = query.data
+        handler = self._callbacks.get(data) or self._callback_prefixes.get(data.partition("_")[0])
+        if handler:
+            await handler(query, user_data)
             
+    async def ask_question(self, query, user_data):
+        """Explain what the user can send."""
+        await query.edit_message_text(_ASK_QUESTION_TEXT, parse_mode=ParseMode.HTML)
+        
+    async def confirm_clear(self, query, user_data):
+        """Confirm the conversation was cleared."""
+        await query.edit_message_text(_CLEAR_DONE_TEXT, parse_mode=ParseMode.HTML)
+        
+    async def cancel_clear(self, query, user_data):
+        """Confirm clearing was cancelled."""
+        await query.edit_message_text(_CLEAR_CANCELLED_TEXT, parse_mode=ParseMode.HTML)
+        
+    async def set_difficulty(self, query, user_data):
+        """Save the quiz difficulty chosen with a difficulty_* button."""
+        difficulty = query.data.split("_")[1]
+        user_data.difficulty = difficulty
+        await asyncio.to_thread(self.user_store.save, query.from_user.id, user_data)
+        await query.edit_message_text(
+            f"✅ <b>Difficulty set to {html.escape(difficulty.title())}!</b>\n\nThis will affect future quizzes and recommendations.",
+            parse_mode=ParseMode.HTML
+        )
+        
     async def generate_quiz(self, query, user_data):
         """Generate an interactive quiz."""
-        subjects = ['Math', 'Science', 'History', 'Literature', 'Geography', 'Physics', 'Chemistry', 'Biology']
-        
-        keyboard = []
-        for i in range(0, len(subjects), 2):
-            row = []
-            row.append(InlineKeyboardButton(f"📚 {subjects[i]}", callback_data=f"quiz_subject_{subjects[i].lower()}"))
-            if i + 1 < len(subjects):
-                row.append(InlineKeyboardButton(f"📚 {subjects[i+1]}", callback_data=f"quiz_subject_{subjects[i+1].lower()}"))
-            keyboard.append(row)
-            
-        keyboard.append([InlineKeyboardButton("🎲 Random Topic", callback_data="quiz_subject_random")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
-            f"🧠 **Quiz Generator** 🎯\n\n🏆 Level {user_data['level']} Student\n\nChoose a subject for your quiz:",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
+            f"🧠 <b>Quiz Generator</b> 🎯\n\n🏆 Level {user_data.level} Student\n\nChoose a subject for your quiz:",
+            reply_markup=_QUIZ_SUBJECT_MARKUP,
+            parse_mode=ParseMode.HTML
         )
         
     async def show_progress(self, query, user_data):
         """Show user progress and statistics."""
-        accuracy = (user_data['correct_answers'] / max(1, user_data['total_questions']) * 100)
-        xp_to_next = (user_data['level'] * 100) - user_data['xp']
-        
-        progress_text = f"""
-📈 **Your Study Progress** 🏆
-
-🎆 **Level:** {user_data['level']}/10
-⚡ **XP:** {user_data['xp']} ({xp_to_next} to next level)
-🔥 **Study Streak:** {user_data['study_streak']} days
-
-📉 **Quiz Statistics:**
-• Questions Answered: {user_data['total_questions']}
-• Correct Answers: {user_data['correct_answers']}
-• Accuracy Rate: {accuracy:.1f}%
-
-📚 **Subjects Studied:** {len(user_data['subjects_studied'])}
-{', '.join(list(user_data['subjects_studied'])[:5]) if user_data['subjects_studied'] else 'None yet'}
-
-📅 **Last Activity:** {user_data['last_activity'][:10] if user_data['last_activity'] else 'Never'}
-        """
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("📈 Detailed Analytics", callback_data="analytics"),
-                InlineKeyboardButton("🏆 Achievements", callback_data="achievements")
-            ],
-            [InlineKeyboardButton("🔙 Back to Main", callback_data="dashboard")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(progress_text, reply_markup=reply_markup, parse_mode='Markdown')
+        level = user_data.level
+        xp = user_data.xp
+        total_questions = user_data.total_questions
+        correct_answers = user_data.correct_answers
+        subjects_studied = user_data.subjects_studied
+        last_activity = user_data.last_activity
+        
+        progress_text = "\n".join([
+            "📈 <b>Your Study Progress</b> 🏆",
+            "",
+            f"🎆 <b>Level:</b> {level}/10",
+            f"⚡ <b>XP:</b> {xp} ({level * 100 - xp} to next level)",
+            f"🔥 <b>Study Streak:</b> {user_data.study_streak} days",
+            "",
+            "📉 <b>Quiz Statistics:</b>",
+            f"• Questions Answered: {total_questions}",
+            f"• Correct Answers: {correct_answers}",
+            f"• Accuracy Rate: {user_data.accuracy:.1f}%",
+            "",
+            f"📚 <b>Subjects Studied:</b> {subjects_studied.bit_count()}",
+            ", ".join(islice(subject_names(subjects_studied), 5)) if subjects_studied else "None yet",
+            "",
+            f"📅 <b>Last Activity:</b> {time.strftime('%Y-%m-%d', time.localtime(last_activity)) if last_activity else 'Never'}"
+        ])
+        
+        await query.edit_message_text(progress_text, reply_markup=_PROGRESS_MARKUP, parse_mode=ParseMode.HTML)
         
     async def show_achievements(self, query, user_data):
         """Show user achievements and badges."""
-        achievements = []
-        
-        # Check various achievements
-        if user_data['total_questions'] >= 10:
-            achievements.append("🎆 Curious Learner (10+ questions)")
-        if user_data['total_questions'] >= 50:
-            achievements.append("🏆 Quiz Master (50+ questions)")
-        if user_data['study_streak'] >= 3:
-            achievements.append("🔥 Study Streak (3+ days)")
-        if user_data['level'] >= 3:
-            achievements.append("⭐ Rising Star (Level 3+)")
-        if user_data['level'] >= 5:
-            achievements.append("🌟 Study Expert (Level 5+)")
-        if len(user_data['subjects_studied']) >= 3:
-            achievements.append("📚 Multi-Subject Scholar")
-            
-        achievement_text = f"""
-🏆 **Your Achievements** 🎆
-
-✨ **Unlocked Badges:**
-{chr(10).join(achievements) if achievements else '❌ No achievements yet - keep studying!'}
-
-🚯 **Upcoming Achievements:**
-• 💯 Perfect Score (100% accuracy in 5 quizzes)
-• 🚀 Knowledge Seeker (Level 10)
-• 🏅 Subject Expert (Master 5 subjects)
-• 🔥 Fire Streak (7-day study streak)
-
-💪 Keep studying to unlock more badges!
-        """
+        # Only 2**len(_ACHIEVEMENTS) screens exist, so they are rendered once per unlocked set
+        unlocked = 0
+        for bit, (stat, threshold, _) in enumerate(_ACHIEVEMENTS):
+            if stat(user_data) >= threshold:
+                unlocked |= 1 << bit
         
-        keyboard = [[InlineKeyboardButton("🔙 Back to Progress", callback_data="show_progress")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(achievement_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await query.edit_message_text(
+            render_achievements(unlocked),
+            reply_markup=_ACHIEVEMENTS_MARKUP,
+            parse_mode=ParseMode.HTML
+        )
         
     async def show_flashcards(self, query, user_data):
         """Show flashcard options."""
         flashcard_text = """
-📋 **Flashcard Generator** 🧠
+📋 <b>Flashcard Generator</b> 🧠
 
 🎯 Create instant flashcards from any content!
 
-🚀 **How to use:**
+🚀 <b>How to use:</b>
 1. Send me any text, image, or topic
 2. Add the word "flashcard" to your message
 3. I'll generate study cards for you!
 
-💡 **Example:**
+💡 <b>Example:</b>
 "Create flashcards about photosynthesis"
 "Make flashcards from this image"
         """
         
-        keyboard = [
-            [
-                InlineKeyboardButton("📝 Create from Text", callback_data="flashcard_text"),
-                InlineKeyboardButton("📸 Create from Image", callback_data="flashcard_image")
-            ],
-            [InlineKeyboardButton("🔙 Back to Main", callback_data="dashboard")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(flashcard_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await query.edit_message_text(flashcard_text, reply_markup=_FLASHCARDS_MARKUP, parse_mode=ParseMode.HTML)
         
     async def show_settings(self, query, user_data):
         """Show user settings and preferences."""
-        current_difficulty = user_data['preferences']['difficulty'].title()
+        current_difficulty = html.escape(user_data.difficulty.title())
         
         settings_text = f"""
-⚙️ **StudySage Settings** 📁
+⚙️ <b>StudySage Settings</b> 📁
 
-🎯 **Current Preferences:**
+🎯 <b>Current Preferences:</b>
 • Difficulty: {current_difficulty}
-• Reminder: {'Set' if user_data['preferences']['reminder_time'] else 'Not set'}
-• Favorite Subjects: {len(user_data['preferences']['favorite_subjects'])}
+• Reminder: {'Set' if user_data.reminder_time else 'Not set'}
+• Favorite Subjects: {len(user_data.favorite_subjects)}
 
-🔧 **Customize your experience:**
+🔧 <b>Customize your experience:</b>
         """
         
-        keyboard = [
-            [
-                InlineKeyboardButton("🎯 Set Difficulty", callback_data="set_difficulty"),
-                InlineKeyboardButton("⏰ Study Reminders", callback_data="set_reminders")
-            ],
-            [
-                InlineKeyboardButton("📚 Favorite Subjects", callback_data="set_subjects"),
-                InlineKeyboardButton("🎨 Personalization", callback_data="personalize")
-            ],
-            [InlineKeyboardButton("🔙 Back to Main", callback_data="dashboard")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(settings_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await query.edit_message_text(settings_text, reply_markup=_SETTINGS_MARKUP, parse_mode=ParseMode.HTML)
         
     async def show_subjects(self, query, user_data):
         """Show subject management."""
-        studied_subjects = list(user_data['subjects_studied'])[:10]  # Show first 10
+        subjects_studied = user_data.subjects_studied
+        lines = ["📚 <b>Subject Management</b> 🎨", "", "🏆 <b>Subjects You've Studied:</b>"]
+        if subjects_studied:
+            lines.extend(f"• {subject}" for subject in islice(subject_names(subjects_studied), 10))  # Show first 10
+        else:
+            lines.append("❌ No subjects studied yet")
+        lines.append(_SUBJECT_CATEGORIES_TEXT)
+        subjects_text = "\n".join(lines)
         
-        subjects_text = f"""
-📚 **Subject Management** 🎨
-
-🏆 **Subjects You've Studied:**
-{chr(10).join([f'• {subject}' for subject in studied_subjects]) if studied_subjects else '❌ No subjects studied yet'}
-
-🚀 **Available Categories:**
-• Mathematics & Algebra
-• Science & Physics
-• Literature & Languages
-• History & Geography
-• Computer Science
-• Arts & Philosophy
-
-💡 Start asking questions to track your subjects!
-        """
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("🧠 Generate Subject Quiz", callback_data="generate_quiz"),
-                InlineKeyboardButton("📈 Subject Analytics", callback_data="analytics")
-            ],
-            [InlineKeyboardButton("🔙 Back to Main", callback_data="dashboard")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(subjects_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await query.edit_message_text(subjects_text, reply_markup=_SUBJECTS_MARKUP, parse_mode=ParseMode.HTML)
         
     async def show_analytics(self, query, user_data):
         """Show detailed analytics."""
-        total_days = max(1, (datetime.datetime.now() - datetime.datetime.fromisoformat(user_data['last_activity'])).days) if user_data['last_activity'] else 1
-        avg_questions = user_data['total_questions'] / total_days
-        
-        analytics_text = f"""
-📈 **Detailed Analytics** 🔍
-
-📅 **Time-based Stats:**
-• Average questions/day: {avg_questions:.1f}
-• Total study sessions: {max(1, user_data['total_questions'] // 5)}
-• Peak performance: Level {user_data['level']}
-
-🏆 **Performance Metrics:**
-• Success rate: {(user_data['correct_answers']/max(1,user_data['total_questions'])*100):.1f}%
-• XP efficiency: {user_data['xp']/(max(1,user_data['total_questions'])):.1f} XP/question
-• Subject diversity: {len(user_data['subjects_studied'])}
-
-📉 **Growth Tracking:**
-• Level progression: {((user_data['level']-1)/9*100):.1f}% complete
-• Knowledge areas: {len(user_data['subjects_studied'])}/20 explored
-
-🚀 **Recommendations:**
-• {'Try more challenging questions!' if user_data['level'] < 5 else 'You are doing great - keep it up!'}
-• {'Explore new subjects!' if len(user_data['subjects_studied']) < 3 else 'Great subject diversity!'}
-        """
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("📧 Export Data", callback_data="export_data"),
-                InlineKeyboardButton("🔄 Reset Stats", callback_data="reset_stats")
-            ],
-            [InlineKeyboardButton("🔙 Back to Progress", callback_data="show_progress")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(analytics_text, reply_markup=reply_markup, parse_mode='Markdown')
+        level = user_data.level
+        total_questions = user_data.total_questions
+        subject_count = user_data.subjects_studied.bit_count()
+        answered = total_questions or 1
+        last_activity = user_data.last_activity
+        total_days = max(1, int((time.time() - last_activity) // 86400)) if last_activity else 1
+        
+        analytics_text = "\n".join([
+            "📈 <b>Detailed Analytics</b> 🔍",
+            "",
+            "📅 <b>Time-based Stats:</b>",
+            f"• Average questions/day: {total_questions / total_days:.1f}",
+            f"• Total study sessions: {max(1, total_questions // 5)}",
+            f"• Peak performance: Level {level}",
+            "",
+            "🏆 <b>Performance Metrics:</b>",
+            f"• Success rate: {user_data.accuracy:.1f}%",
+            f"• XP efficiency: {user_data.xp / answered:.1f} XP/question",
+            f"• Subject diversity: {subject_count}",
+            "",
+            "📉 <b>Growth Tracking:</b>",
+            f"• Level progression: {(level - 1) / 9 * 100:.1f}% complete",
+            f"• Knowledge areas: {subject_count}/20 explored",
+            "",
+            "🚀 <b>Recommendations:</b>",
+            "• Try more challenging questions!" if level < 5 else "• You are doing great - keep it up!",
+            "• Explore new subjects!" if subject_count < 3 else "• Great subject diversity!"
+        ])
+        
+        await query.edit_message_text(analytics_text, reply_markup=_ANALYTICS_MARKUP, parse_mode=ParseMode.HTML)
         
     async def handle_quiz_answer(self, query, user_data):
         """Handle quiz answers and generate questions."""
@@ -734,272 +1144,272 @@ Transcribe and respond to this voice message:
             # Generate quiz question using AI
             await self.generate_quiz_question(query, subject, user_data)
             
-    async def generate_quiz_question(self, query, subject, user_data):
-        """Generate an AI-powered quiz question."""
-        difficulty = user_data['preferences']['difficulty']
-        level = user_data['level']
+    async def generate_quiz_text(self, subject: str, difficulty: str, level: int) -> str:
+        """Ask Gemini for one quiz question; returns an empty string if it produced nothing."""
+        quiz_prompt = _QUIZ_PROMPT.format_map({'subject': subject, 'difficulty': difficulty, 'level': level})
         
-        quiz_prompt = f"""
-Generate a {difficulty} difficulty {subject} quiz question suitable for a Level {level} student.
-
-Format your response EXACTLY like this:
-**Question:** [Your question here]
-
-**A)** [Option A]
-**B)** [Option B] 
-**C)** [Option C]
-**D)** [Option D]
-
-**Correct Answer:** [A, B, C, or D]
-**Explanation:** [Brief explanation why this is correct]
-
-Make it educational and engaging!
-        """
+        response = await genai_client.aio.models.generate_content(
+            model=MODEL_NAME,
+            contents=quiz_prompt
+        )
+        return response.text.strip() if response and response.text else ""
         
+    async def refill_quiz_pool(self, key) -> None:
+        """Generate a batch of questions for key in the background and add them to the pool."""
         try:
-            response = genai_client.models.generate_content(
-                model=self.model,
-                contents=quiz_prompt
-            )
-            
-            if response and response.text:
-                quiz_text = response.text.strip()
+            questions = await asyncio.gather(*(self.generate_quiz_text(*key) for _ in range(self.quiz_pool_batch)))
+        except Exception as e:
+            # Nothing awaits this task, so an uncaught error would only surface as
+            # "Task exception was never retrieved"
+            logger.warning("Error refilling quiz pool for %s: %s", key, e)
+            return
+        for question in questions:
+            if question:
+                self.quiz_pool.add(key, question)
                 
-                # Create answer buttons
-                keyboard = [
-                    [
-                        InlineKeyboardButton("🅰️ A", callback_data="quiz_answer_A"),
-                        InlineKeyboardButton("🅱️ B", callback_data="quiz_answer_B")
-                    ],
-                    [
-                        InlineKeyboardButton("🄲️ C", callback_data="quiz_answer_C"),
-                        InlineKeyboardButton("🄳️ D", callback_data="quiz_answer_D")
-                    ],
-                    [
-                        InlineKeyboardButton("🔄 New Question", callback_data="generate_quiz"),
-                        InlineKeyboardButton("🔙 Main Menu", callback_data="dashboard")
-                    ]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+    async def generate_quiz_question(self, query, subject, user_data):
+        """Show an AI-powered quiz question, served from the pre-generated pool when possible."""
+        if not genai_client:
+            await query.edit_message_text(_AI_UNAVAILABLE_TEXT)
+            return
+            
+        key = (subject, user_data.difficulty, user_data.level)
+        
+        try:
+            # Only an empty pool has to wait for Gemini
+            quiz_text = self.quiz_pool.pop(key) or await self.generate_quiz_text(*key)
+            
+            # Top the pool up in the background so the next question is instant
+            if self.quiz_pool.size(key) < self.quiz_pool_low and key not in self._quiz_refills:
+                refill = asyncio.create_task(self.refill_quiz_pool(key))
+                self._quiz_refills[key] = refill
+                refill.add_done_callback(lambda _: self._quiz_refills.pop(key, None))
                 
+            if quiz_text:
                 await query.edit_message_text(
-                    f"🧠 **{subject} Quiz** 🏆\n\n{quiz_text}",
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
+                    f"🧠 <b>{subject} Quiz</b> 🏆\n\n{markdown_to_html(quiz_text)}",
+                    reply_markup=_QUIZ_ANSWER_MARKUP,
+                    parse_mode=ParseMode.HTML
                 )
                 
                 # Store quiz data for answer checking
                 context_data = query.message.chat.id
                 
+                # Count the quiz subject as studied
+                await self.update_user_stats(query.from_user.id, subject)
+                
             else:
                 await query.edit_message_text("⚠️ Failed to generate quiz. Please try again!")
                 
         except Exception as e:
-            logger.error(f"Quiz generation error: {e}")
+            logger.error("Quiz generation error: %s", e)
             await query.edit_message_text("⚠️ Quiz generation failed. Please try again later.")
             
     async def quiz_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Quick quiz command."""
-        user_data = self.get_user_data(update.effective_user.id)
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("🧠 Start Quiz", callback_data="generate_quiz"),
-                InlineKeyboardButton("📈 My Progress", callback_data="show_progress")
-            ],
-            [
-                InlineKeyboardButton("🎯 Practice Mode", callback_data="practice_mode"),
-                InlineKeyboardButton("📚 Study Subjects", callback_data="subjects")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        user_data = await self.get_user_data(update.effective_user.id)
         
         await update.message.reply_text(
-            f"🧠 **Quick Quiz Access** 🎯\n\n🏆 Level {user_data['level']} Student\n\nReady to test your knowledge?",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
+            _QUIZ_COMMAND_TEXT.format(level=user_data.level),
+            reply_markup=_QUIZ_COMMAND_MARKUP,
+            parse_mode=ParseMode.HTML
         )
         
     async def progress_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Quick progress command."""
-        user_data = self.get_user_data(update.effective_user.id)
-        accuracy = (user_data['correct_answers'] / max(1, user_data['total_questions']) * 100)
-        
-        progress_text = f"""
-📈 **Quick Progress Check** 🏆
-
-🎆 Level: {user_data['level']}/10 (⚡ {user_data['xp']} XP)
-🔥 Study Streak: {user_data['study_streak']} days
-🎯 Accuracy: {accuracy:.1f}% ({user_data['correct_answers']}/{user_data['total_questions']})
-📚 Subjects: {len(user_data['subjects_studied'])}
-        """
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("📈 Detailed Stats", callback_data="analytics"),
-                InlineKeyboardButton("🏆 Achievements", callback_data="achievements")
-            ],
-            [InlineKeyboardButton("🚀 Dashboard", callback_data="dashboard")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        user_data = await self.get_user_data(update.effective_user.id)
+        
+        progress_text = _PROGRESS_COMMAND_TEXT.format(
+            level=user_data.level,
+            xp=user_data.xp,
+            study_streak=user_data.study_streak,
+            accuracy=user_data.accuracy,
+            correct_answers=user_data.correct_answers,
+            total_questions=user_data.total_questions,
+            subject_count=user_data.subjects_studied.bit_count()
+        )
         
-        await update.message.reply_text(progress_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await update.message.reply_text(progress_text, reply_markup=_PROGRESS_COMMAND_MARKUP, parse_mode=ParseMode.HTML)
         
     async def subjects_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Quick subjects command."""
-        user_data = self.get_user_data(update.effective_user.id)
-        studied = list(user_data['subjects_studied'])[:5]
-        
-        subjects_text = f"""
-📚 **Subject Quick Access** 🎨
-
-🏆 Your studied subjects ({len(user_data['subjects_studied'])}):
-{chr(10).join([f'• {subject}' for subject in studied]) if studied else '❌ Start studying to track subjects!'}
-
-🚀 What would you like to do?
-        """
+        user_data = await self.get_user_data(update.effective_user.id)
+        studied = list(islice(subject_names(user_data.subjects_studied), 5))
         
-        keyboard = [
-            [
-                InlineKeyboardButton("🧠 Subject Quiz", callback_data="generate_quiz"),
-                InlineKeyboardButton("📋 Subject Analytics", callback_data="analytics")
-            ],
-            [
-                InlineKeyboardButton("📝 Ask Question", callback_data="ask_question"),
-                InlineKeyboardButton("🚀 Dashboard", callback_data="dashboard")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        subjects_text = _SUBJECTS_COMMAND_TEXT.format(
+            subject_count=user_data.subjects_studied.bit_count(),
+            subject_list="\n".join(f'• {subject}' for subject in studied) if studied else '❌ Start studying to track subjects!'
+        )
         
-        await update.message.reply_text(subjects_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await update.message.reply_text(subjects_text, reply_markup=_SUBJECTS_COMMAND_MARKUP, parse_mode=ParseMode.HTML)
         
     async def show_dashboard(self, query, user_data):
         """Show main dashboard."""
-        user_name = query.from_user.first_name or "Student"
-        
-        dashboard_text = f"""
-🎓 **StudySage Pro Dashboard** 🤖✨
-
-Welcome back, {user_name}! 🚀
-
-🏆 **Your Progress:**
-• Level {user_data['level']} 🎆 ({user_data['xp']} XP)
-• Study Streak: {user_data['study_streak']} days 🔥
-• Questions Answered: {user_data['total_questions']}
-• Accuracy: {(user_data['correct_answers']/max(1,user_data['total_questions'])*100):.1f}%
-
-🚀 **What would you like to do?**
-        """
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("📝 Ask Question", callback_data="ask_question"),
-                InlineKeyboardButton("🧠 Generate Quiz", callback_data="generate_quiz")
-            ],
-            [
-                InlineKeyboardButton("📊 My Progress", callback_data="show_progress"),
-                InlineKeyboardButton("🏆 Achievements", callback_data="achievements")
-            ],
-            [
-                InlineKeyboardButton("📋 Flashcards", callback_data="flashcards"),
-                InlineKeyboardButton("⚙️ Settings", callback_data="settings")
-            ],
-            [
-                InlineKeyboardButton("📚 Study Subjects", callback_data="subjects"),
-                InlineKeyboardButton("📈 Analytics", callback_data="analytics")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        dashboard_text = _DASHBOARD_TEXT.format(
+            user_name=html.escape(query.from_user.first_name or "Student"),
+            level=user_data.level,
+            xp=user_data.xp,
+            study_streak=user_data.study_streak,
+            total_questions=user_data.total_questions,
+            accuracy=user_data.accuracy
+        )
         
-        await query.edit_message_text(dashboard_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await query.edit_message_text(dashboard_text, reply_markup=_MAIN_MENU_MARKUP, parse_mode=ParseMode.HTML)
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle incoming messages and generate AI responses."""
-        if not genai_client:
-            await update.message.reply_text(
-                "❌ AI service is not available. Please check the configuration."
-            )
-            return
-
-        user_message = update.message.text
+        # Bind the attributes used throughout the handler once
+        message = update.message
+        reply = message.reply_text
+        response_cache = self.response_cache
+        semantic_cache = self.semantic_cache
+        user_message = message.text
         user_name = update.effective_user.first_name or "Student"
         
         # Log the incoming message
-        logger.info(f"User {user_name}: {user_message}")
+        logger.info("User %s: %s", user_name, user_message)
+        
+        # Serve repeated questions straight from the cache
+        cache_key = make_cache_key(MODEL_NAME, normalize_prompt(user_message))
+        cached_response = await asyncio.to_thread(response_cache.get, cache_key)
+        if cached_response:
+            await self.reply_long_text(message, cached_response)
+            logger.info("Cached AI response sent to %s", user_name)
+            return
         
-        # Show typing indicator
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
+        pending = self._pending_answers.get(cache_key)
+        if pending is not None:
+            # shield: a cancelled waiter must not cancel the answer others wait for
+            cached_response = await asyncio.shield(pending)
+            if cached_response:
+                await self.reply_long_text(message, cached_response)
+                logger.info("Shared in-flight AI response sent to %s", user_name)
+                return
+        
+        # Show typing indicator in the background; it is dropped if the semantic cache
+        # answers first, and otherwise overlaps with generation
+        typing_task = asyncio.create_task(self.send_typing(update, context))
+        pending = self._pending_answers[cache_key] = asyncio.get_running_loop().create_future()
         
         try:
-            # Create enhanced prompt for study assistance
-            enhanced_prompt = f"""
-You are StudySage, an intelligent and helpful study assistant. A student named {user_name} has asked you: "{user_message}"
-
-Please provide a clear, educational, and helpful response. Follow these guidelines:
-- Be encouraging and supportive
-- Explain concepts clearly and step-by-step when needed
-- Provide examples where helpful
-- If it's a homework question, guide them through the thinking process rather than just giving the answer
-- Use appropriate emojis to make the response engaging
-- Keep responses concise but comprehensive
-- If the question is unclear, ask for clarification
-
-Student's question: {user_message}
-            """
+            # Fall back to answers this chat already got for paraphrased questions. Semantic
+            # scans and cache writes do SQLite I/O and pure-Python vector math, so they run
+            # in worker threads instead of on the event loop. The embedding is a Gemini
+            # round trip of its own, so it is only made before generation when the chat
+            # has answers it could match. A match is only good for this chat, so it is
+            # neither promoted to the shared exact-match cache nor handed to other chats
+            # waiting on the same question
+            chat_key = make_cache_key(EMBEDDING_MODEL_NAME, str(update.effective_chat.id))
+            prompt_text = normalize_prompt(user_message)
+            embedding = None
+            if await asyncio.to_thread(semantic_cache.has_entries, chat_key):
+                embedding = await self.embed_text(prompt_text)
+            cached_response = embedding and await asyncio.to_thread(semantic_cache.lookup, chat_key, embedding)
+            if cached_response:
+                typing_task.cancel()
+                await self.reply_long_text(message, cached_response)
+                logger.info("Semantically cached AI response sent to %s", user_name)
+                return
             
-            # Generate response using Gemini
-            response = genai_client.models.generate_content(
-                model=self.model,
-                contents=enhanced_prompt
-            )
+            # Compound questions whose parts were answered before only need a short
+            # merge prompt instead of a full generation
+            partial_answers = await asyncio.to_thread(semantic_cache.partial_matches, chat_key, embedding) if embedding else []
+            if partial_answers:
+                enhanced_prompt = _MERGE_PROMPT.format_map({
+                    'user_message': user_message,
+                    'partial_answers': "\n---\n".join(partial_answers)
+                })
+                logger.info("Merging %d cached answers for %s", len(partial_answers), user_name)
+            else:
+                # Create enhanced prompt for study assistance (kept free of the student's
+                # name so the answer can be cached and shared)
+                enhanced_prompt = _MESSAGE_PROMPT.format_map({'user_message': user_message})
             
-            if response and response.text:
-                # Split long messages to avoid Telegram's 4096 character limit
-                ai_response = response.text.strip()
-                if len(ai_response) > 4000:
-                    # Split into chunks
-                    chunks = [ai_response[i:i+4000] for i in range(0, len(ai_response), 4000)]
-                    for chunk in chunks:
-                        await update.message.reply_text(chunk)
-                else:
-                    await update.message.reply_text(ai_response)
+            # Stream the Gemini response to the chat as it is generated
+            ai_response = await self.stream_reply(message, enhanced_prompt)
+            pending.set_result(ai_response)
+            
+            if ai_response:
+                await asyncio.to_thread(response_cache.set, cache_key, ai_response)
+                # The answer is already delivered; embedding it for later paraphrases
+                # happens in the background
+                remember = asyncio.create_task(self.remember_answer(chat_key, prompt_text, ai_response, embedding))
+                self._background_tasks.add(remember)
+                remember.add_done_callback(self._background_tasks.discard)
                     
-                logger.info(f"AI response sent to {user_name}")
+                logger.info("AI response sent to %s", user_name)
             else:
-                await update.message.reply_text(
+                await reply(
                     "🤔 I'm having trouble generating a response right now. Please try again in a moment."
                 )
                 
         except Exception as e:
-            logger.error(f"Error generating AI response: {e}")
-            await update.message.reply_text(
+            logger.error("Error generating AI response: %s", e)
+            await reply(
                 "⚠️ Sorry, I encountered an error while processing your request. Please try again."
             )
+        finally:
+            # Waiters given no answer generate their own
+            if self._pending_answers.get(cache_key) is pending:
+                del self._pending_answers[cache_key]
+            if not pending.done():
+                pending.set_result("")
+
+    async def ai_unavailable(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Tell the user AI features are off when Gemini is not configured."""
+        await update.message.reply_text(_AI_UNAVAILABLE_TEXT)
 
     async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Log errors and notify the user."""
-        logger.error(f"Update {update} caused error {context.error}")
+        logger.error("Update %s caused error %s", update, context.error)
         
         if hasattr(update, 'effective_message') and update.effective_message:
-            await update.effective_message.reply_text(
-                "❌ An unexpected error occurred. Please try again later."
-            )
+            await update.effective_message.reply_text(_UNEXPECTED_ERROR_TEXT)
 
 def main():
     """Start the bot."""
     if not BOT_TOKEN:
         logger.error("TELEGRAM_BOT_TOKEN not found in environment variables")
         return
-        
-    if not GEMINI_API_KEY:
-        logger.error("GEMINI_API_KEY not found in environment variables")
-        return
+    
+    # Use the libuv-based event loop where available (uvloop does not support Windows).
+    # PTB runs on the current event loop, so setting one here is enough; uvloop.install()
+    # would swap the global policy, which is deprecated from Python 3.12
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop not installed, using the default asyncio event loop")
+    else:
+        asyncio.set_event_loop(uvloop.new_event_loop())
     
     # Create bot instance
     bot = StudySageBot()
     
-    # Create application
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Create application. Updates are handled concurrently so a slow Gemini call for
+    # one user doesn't hold up everyone else. HTTP/2 lets concurrent replies share one
+    # connection to the Bot API (long polling gets its own request object, as PTB
+    # requires), and the rate limiter keeps bursts of replies under Telegram's
+    # 30 messages/second bot limit. Bursts wait up to pool_timeout for a free
+    # connection instead of failing with PTB's 1 second default. Both request objects
+    # decode responses (including every polled update) with orjson
+    application = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(256)
+        .request(OrjsonRequest(
+            connection_pool_size=256,
+            http_version="2",
+            connect_timeout=10,
+            read_timeout=30,
+            write_timeout=30,
+            pool_timeout=30
+        ))
+        .get_updates_request(OrjsonRequest(connection_pool_size=1, http_version="2"))
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        .post_init(bot.post_init)
+        .post_shutdown(bot.post_shutdown)
+        .build()
+    )
     
     # Command handlers
     application.add_handler(CommandHandler("start", bot.start_command))
@@ -1012,24 +1422,64 @@ def main():
     # Callback query handler for interactive buttons
     application.add_handler(CallbackQueryHandler(bot.handle_callback))
     
-    # Media handlers
-    application.add_handler(MessageHandler(filters.PHOTO, bot.handle_photo))
-    application.add_handler(MessageHandler(filters.VIDEO, bot.handle_video))
-    application.add_handler(MessageHandler(filters.VOICE, bot.handle_voice))
-    
-    # Text message handler (keep this last to avoid conflicts)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_message))
+    if genai_client:
+        # Media handlers; they wait on downloads and Gemini for seconds at a time, so
+        # they run as their own tasks instead of holding up the update they came from
+        application.add_handler(MessageHandler(filters.PHOTO, bot.per_user(bot.handle_photo), block=False))
+        application.add_handler(MessageHandler(filters.VIDEO, bot.per_user(bot.handle_video), block=False))
+        application.add_handler(MessageHandler(filters.VOICE, bot.per_user(bot.handle_voice), block=False))
+        
+        # Text message handler (keep this last to avoid conflicts)
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.per_user(bot.handle_message)))
+    else:
+        # Without Gemini a single handler answers every AI request, so the AI
+        # handlers above don't need to re-check the client on each message
+        application.add_handler(MessageHandler(
+            (filters.PHOTO | filters.VIDEO | filters.VOICE | filters.TEXT) & ~filters.COMMAND,
+            bot.ai_unavailable
+        ))
     
     # Add error handler
     application.add_error_handler(bot.error_handler)
     
+    # Hand log records to a background thread from here on, so writing them to the
+    # console never blocks the event loop
+    root_logger = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, *root_logger.handlers, respect_handler_level=True)
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    log_listener.start()
+    
     # Start the bot
     logger.info("StudySage bot is starting...")
     print("🚀 StudySage bot is running!")
     print("Press Ctrl+C to stop the bot")
     
-    # Run the bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Run the bot. Only messages and button presses are handled, so Telegram is asked
+    # not to send any other update types
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
+    try:
+        if WEBHOOK_URL:
+            # Telegram pushes each update as it happens, instead of the bot holding a
+            # getUpdates long poll open. The secret keeps the endpoint private: without
+            # it anyone could post forged updates, so one is generated when none is set
+            # (the webhook is re-registered with it on every start)
+            webhook_secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+            application.run_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=webhook_secret,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{webhook_secret}",
+                secret_token=webhook_secret,
+                allowed_updates=allowed_updates
+            )
+        else:
+            # Hold each getUpdates call open for up to 50 seconds rather than PTB's 10,
+            # so an idle bot makes a fifth of the round trips
+            application.run_polling(allowed_updates=allowed_updates, timeout=50)
+    finally:
+        # Flush the records still queued
+        log_listener.stop()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
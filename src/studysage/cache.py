@@ -0,0 +1,221 @@
+"""
+StudySage caches - reuse Gemini answers for repeated prompts and keep pre-generated quiz questions
+"""
+
+import hashlib
+import math
+import operator
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+
+def normalize_prompt(text: str) -> str:
+    """Lowercase and collapse whitespace so trivially different prompts share a key."""
+    return " ".join(text.lower().split())
+
+
+def make_cache_key(*parts: str) -> str:
+    """Hash key parts, joined by a separator that never appears in user text, to a fixed-size key."""
+    return hashlib.blake2b("\x1f".join(parts).encode(), digest_size=16).hexdigest()
+
+
+class ResponseCache:
+    """Exact-match response cache: an in-memory LRU in front of a SQLite table with a TTL."""
+
+    def __init__(self, path: str, maxsize: int = 1024, ttl: int = 24 * 60 * 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expires_at, response), most recently used last
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for key, or None if missing or expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    return entry[1]
+                del self._memory[key]
+
+            row = self._db.execute(
+                "SELECT expires_at, response FROM responses WHERE key = ? AND expires_at > ?",
+                (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self._remember(key, row[0], row[1])
+            return row[1]
+
+    def set(self, key: str, response: str) -> None:
+        """Store a response in memory and on disk."""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, response)
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, expires_at) VALUES (?, ?, ?)",
+                (key, response, expires_at)
+            )
+
+    def _remember(self, key: str, expires_at: float, response: str) -> None:
+        self._memory[key] = (expires_at, response)
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+
+class SemanticCache:
+    """Embedding cache that serves stored answers to paraphrased prompts via cosine similarity."""
+
+    def __init__(self, path: str, threshold: float = 0.85, ttl: int = 24 * 60 * 60,
+                 max_entries: int = 256, partial_threshold: float = 0.6,
+                 combined_threshold: float = 1.4):
+        self.threshold = threshold
+        # A miss can still be answered by merging several partially related answers
+        # when each is at least partial_threshold similar and together they reach
+        # combined_threshold
+        self.partial_threshold = partial_threshold
+        self.combined_threshold = combined_threshold
+        self.ttl = ttl
+        # Per-namespace cap so a lookup never scans more than max_entries vectors
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_responses "
+            "(id INTEGER PRIMARY KEY, namespace TEXT NOT NULL, media_key TEXT NOT NULL, "
+            "embedding BLOB NOT NULL, response TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS semantic_responses_namespace "
+            "ON semantic_responses (namespace, media_key)"
+        )
+        self._db.execute("DELETE FROM semantic_responses WHERE expires_at <= ?", (time.time(),))
+
+    def has_entries(self, namespace: str, media_key: str = "") -> bool:
+        """Return whether there are any unexpired responses to compare against."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM semantic_responses "
+                "WHERE namespace = ? AND media_key = ? AND expires_at > ? LIMIT 1",
+                (namespace, media_key, time.time())
+            ).fetchone()
+        return row is not None
+
+    def lookup(self, namespace: str, embedding: Sequence[float], media_key: str = "") -> Optional[str]:
+        """Return the closest stored response if it is similar enough, else None."""
+        query = _unit_vector(embedding)
+        best_similarity, best_response = -1.0, None
+        for similarity, response in self._scan(namespace, media_key, query):
+            if similarity > best_similarity:
+                best_similarity, best_response = similarity, response
+        if best_similarity >= self.threshold:
+            return best_response
+        return None
+
+    def partial_matches(self, namespace: str, embedding: Sequence[float], k: int = 5,
+                        media_key: str = "") -> List[str]:
+        """Return up to k related responses worth merging, or [] if they don't cover the prompt."""
+        query = _unit_vector(embedding)
+        matches = sorted(
+            (match for match in self._scan(namespace, media_key, query)
+             if match[0] >= self.partial_threshold),
+            key=operator.itemgetter(0),
+            reverse=True
+        )[:k]
+        if sum(similarity for similarity, _ in matches) <= self.combined_threshold:
+            return []
+        return [response for _, response in matches]
+
+    def store(self, namespace: str, embedding: Sequence[float], response: str, media_key: str = "") -> None:
+        """Store a response under its prompt embedding, evicting the oldest entries past the cap."""
+        blob = _unit_vector(embedding).tobytes()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO semantic_responses (namespace, media_key, embedding, response, expires_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (namespace, media_key, blob, response, time.time() + self.ttl)
+            )
+            self._db.execute(
+                "DELETE FROM semantic_responses WHERE namespace = ? AND id NOT IN "
+                "(SELECT id FROM semantic_responses WHERE namespace = ? ORDER BY id DESC LIMIT ?)",
+                (namespace, namespace, self.max_entries)
+            )
+
+    def _scan(self, namespace: str, media_key: str, query: "array[float]") -> List[Tuple[float, str]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT embedding, response FROM semantic_responses "
+                "WHERE namespace = ? AND media_key = ? AND expires_at > ?",
+                (namespace, media_key, time.time())
+            ).fetchall()
+        results = []
+        for blob, response in rows:
+            stored = array("f")
+            stored.frombytes(blob)
+            if len(stored) == len(query):
+                # Both vectors are unit length, so the dot product is the cosine similarity
+                results.append((sum(map(operator.mul, stored, query)), response))
+        return results
+
+
+class QuizPool:
+    """Pre-generated quiz questions per (subject, difficulty, level), saved across restarts."""
+
+    def __init__(self, path: str, maxlen: int = 20):
+        self._pools: Dict[Tuple[str, str, int], Deque[str]] = defaultdict(lambda: deque(maxlen=maxlen))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS quiz_pool "
+            "(subject TEXT NOT NULL, difficulty TEXT NOT NULL, level INTEGER NOT NULL, question TEXT NOT NULL)"
+        )
+        for subject, difficulty, level, question in self._db.execute(
+            "SELECT subject, difficulty, level, question FROM quiz_pool ORDER BY rowid"
+        ):
+            self._pools[(subject, difficulty, level)].append(question)
+
+    def pop(self, key: Tuple[str, str, int]) -> Optional[str]:
+        """Take the oldest pooled question for key, or None if the pool is empty."""
+        pool = self._pools.get(key)
+        return pool.popleft() if pool else None
+
+    def add(self, key: Tuple[str, str, int], question: str) -> None:
+        """Add a question to the pool for key, dropping the oldest once it is full."""
+        self._pools[key].append(question)
+
+    def size(self, key: Tuple[str, str, int]) -> int:
+        """Return how many questions are pooled for key."""
+        pool = self._pools.get(key)
+        return len(pool) if pool else 0
+
+    def save(self) -> None:
+        """Replace the saved pools with the current ones."""
+        rows = [(*key, question) for key, pool in list(self._pools.items()) for question in list(pool)]
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.execute("DELETE FROM quiz_pool")
+            self._db.executemany(
+                "INSERT INTO quiz_pool (subject, difficulty, level, question) VALUES (?, ?, ?, ?)", rows
+            )
+            self._db.execute("COMMIT")
+
+
+def _unit_vector(values: Sequence[float]) -> "array[float]":
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return array("f", (v / norm for v in values))
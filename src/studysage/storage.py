@@ -0,0 +1,80 @@
+"""
+StudySage user store - persist student profiles across restarts
+"""
+
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Final, Iterator, List, Optional
+
+import orjson
+
+# Subjects whose study is tracked, in bit order: a profile stores the ones studied as a
+# single int bitmask. Only append to this tuple, so saved masks keep their meaning.
+SUBJECTS: Final = ('Math', 'Science', 'History', 'Literature', 'Geography', 'Physics', 'Chemistry', 'Biology')
+SUBJECT_BITS: Final = {name: 1 << i for i, name in enumerate(SUBJECTS)}
+
+
+def subject_names(mask: int) -> Iterator[str]:
+    """Yield the names of the subjects set in mask, in SUBJECTS order."""
+    return (name for name, bit in SUBJECT_BITS.items() if mask & bit)
+
+
+@dataclass(slots=True)
+class UserState:
+    """A student's progress and preferences."""
+    study_streak: int = 0
+    total_questions: int = 0
+    correct_answers: int = 0
+    accuracy: float = 0.0  # percent, kept in step with the two counters above
+    subjects_studied: int = 0  # bitmask over SUBJECTS
+    last_activity: Optional[float] = None  # epoch seconds
+    level: int = 1
+    xp: int = 0
+    difficulty: str = 'medium'
+    reminder_time: Optional[float] = None
+    favorite_subjects: List[str] = field(default_factory=list)
+
+
+class UserStore:
+    """User profiles in a SQLite table, with an LRU of recently active users kept in memory."""
+
+    def __init__(self, path: str, maxsize: int = 1024):
+        self.maxsize = maxsize
+        # user_id -> profile, most recently used last
+        self._memory: "OrderedDict[int, UserState]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # Profiles are stored as orjson bytes
+        self._db.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, json BLOB NOT NULL)")
+
+    def get(self, user_id: int) -> Optional[UserState]:
+        """Return the user's profile, loading it from disk if it isn't in memory, or None."""
+        with self._lock:
+            data = self._memory.get(user_id)
+            if data is not None:
+                self._memory.move_to_end(user_id)
+                return data
+
+            row = self._db.execute("SELECT json FROM users WHERE id = ?", (user_id,)).fetchone()
+            if row is None:
+                return None
+            data = UserState(**orjson.loads(row[0]))
+            self._remember(user_id, data)
+            return data
+
+    def save(self, user_id: int, data: UserState) -> None:
+        """Write the user's profile to disk and keep it in memory."""
+        payload = orjson.dumps(data)
+        with self._lock:
+            self._remember(user_id, data)
+            self._db.execute("INSERT OR REPLACE INTO users (id, json) VALUES (?, ?)", (user_id, payload))
+
+    def _remember(self, user_id: int, data: UserState) -> None:
+        self._memory[user_id] = data
+        self._memory.move_to_end(user_id)
+        if len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
@@ -0,0 +1,133 @@
+"""
+Tests for the bot's pure helpers
+"""
+
+import asyncio
+
+import pytest
+from telegram.error import TelegramError
+
+from studysage.bot import (
+    _ACHIEVEMENTS,
+    OrjsonRequest,
+    StudySageBot,
+    find_break,
+    iter_message_chunks,
+    markdown_to_html,
+    render_achievements,
+)
+from studysage.storage import SUBJECT_BITS, UserState
+
+
+def test_find_break_prefers_paragraphs():
+    text = "First sentence. Still first.\n\nSecond paragraph. More"
+    cut, resume = find_break(text, 0, len(text))
+    assert text[:cut] == "First sentence. Still first."
+    assert text[resume:] == "Second paragraph. More"
+
+
+def test_find_break_falls_back_to_sentence_line_then_space():
+    sentence = "One. Two three"
+    cut, resume = find_break(sentence, 0, len(sentence))
+    assert (sentence[:cut], sentence[resume:]) == ("One.", "Two three")
+
+    line = "one two\nthree four"
+    cut, resume = find_break(line, 0, len(line))
+    assert (line[:cut], line[resume:]) == ("one two", "three four")
+
+    words = "one two three"
+    cut, resume = find_break(words, 0, len(words))
+    assert (words[:cut], words[resume:]) == ("one two", "three")
+
+
+def test_find_break_splits_hard_without_any_break():
+    assert find_break("x" * 100, 0, 40) == (40, 40)
+
+
+def test_find_break_ignores_a_break_at_the_start():
+    # Breaking there would yield an empty chunk
+    assert find_break("\nabcdef", 0, 5) == (5, 5)
+
+
+@pytest.mark.parametrize("text", [
+    "word " * 3000,
+    "line\n" * 2500,
+    "Sentence one. " * 1000,
+    "Paragraph text here.\n\n" * 600,
+    "x" * 9001,
+])
+def test_iter_message_chunks_respects_limit_and_keeps_text(text):
+    chunks = list(iter_message_chunks(text, limit=4000))
+    assert len(chunks) > 1
+    assert all(0 < len(chunk) <= 4000 for chunk in chunks)
+    # Only the separators the text was split at are dropped
+    assert "".join(chunks).replace(" ", "").replace("\n", "") == text.replace(" ", "").replace("\n", "")
+
+
+def test_iter_message_chunks_short_text_is_one_chunk():
+    assert list(iter_message_chunks("hello")) == ["hello"]
+    assert list(iter_message_chunks("")) == []
+
+
+def test_markdown_to_html_escapes_and_converts_bold():
+    assert markdown_to_html("**Question:** is 1 < 2 & 3 > 2?") == (
+        "<b>Question:</b> is 1 &lt; 2 &amp; 3 &gt; 2?"
+    )
+    assert markdown_to_html("**<script>**") == "<b>&lt;script&gt;</b>"
+    assert markdown_to_html('say "hi"') == 'say "hi"'
+
+
+def test_render_achievements_lists_unlocked_badges_in_order():
+    text = render_achievements(0b101)
+    labels = [label for _, _, label in _ACHIEVEMENTS]
+    assert labels[0] in text and labels[2] in text
+    assert labels[1] not in text
+    assert text.index(labels[0]) < text.index(labels[2])
+    assert "No achievements yet" not in text
+
+
+def test_render_achievements_without_badges():
+    text = render_achievements(0)
+    assert "No achievements yet" in text
+    assert not any(label in text for _, _, label in _ACHIEVEMENTS)
+
+
+class _Query:
+    def __init__(self):
+        self.text = None
+
+    async def edit_message_text(self, text, **kwargs):
+        self.text = text
+
+
+def _achievements_screen(user_data):
+    query = _Query()
+    # show_achievements uses no instance state, so skip __init__ and its databases
+    asyncio.run(StudySageBot.__new__(StudySageBot).show_achievements(query, user_data))
+    return query.text
+
+
+def test_show_achievements_unlocks_badges_from_thresholds():
+    user_data = UserState(
+        total_questions=12,
+        level=3,
+        subjects_studied=SUBJECT_BITS['Math'] | SUBJECT_BITS['History'] | SUBJECT_BITS['Physics']
+    )
+    assert _achievements_screen(user_data) == render_achievements(0b101001)
+
+
+def test_show_achievements_for_new_student():
+    assert _achievements_screen(UserState()) == render_achievements(0)
+
+
+def test_parse_json_payload_uses_orjson():
+    assert OrjsonRequest.parse_json_payload('{"ok": true, "text": "é"}'.encode()) == {"ok": True, "text": "é"}
+
+
+def test_parse_json_payload_replaces_invalid_utf8():
+    assert OrjsonRequest.parse_json_payload(b'{"text": "\xff"}') == {"text": "�"}
+
+
+def test_parse_json_payload_raises_telegram_error_on_invalid_json():
+    with pytest.raises(TelegramError):
+        OrjsonRequest.parse_json_payload(b"not json")
@@ -0,0 +1,144 @@
+"""
+Tests for the response caches and quiz pool
+"""
+
+import pytest
+
+from studysage import cache
+from studysage.cache import QuizPool, ResponseCache, SemanticCache, make_cache_key, normalize_prompt
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "cache.db")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Freeze cache.time.time at a value the test can move forward."""
+    now = [1_000_000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    return now
+
+
+def test_normalize_prompt_collapses_case_and_whitespace():
+    assert normalize_prompt("  What IS\n photosynthesis?\t") == "what is photosynthesis?"
+
+
+def test_make_cache_key_is_stable_and_keeps_parts_apart():
+    assert make_cache_key("model", "question") == make_cache_key("model", "question")
+    assert make_cache_key("a b", "c") != make_cache_key("a", "b c")
+    assert len(make_cache_key("x" * 10_000)) == 32
+
+
+def test_response_cache_round_trip_survives_restart(db_path):
+    ResponseCache(db_path).set("key", "answer")
+    assert ResponseCache(db_path).get("key") == "answer"
+    assert ResponseCache(db_path).get("missing") is None
+
+
+def test_response_cache_expires_entries(db_path, clock):
+    responses = ResponseCache(db_path, ttl=60)
+    responses.set("key", "answer")
+    clock[0] += 59
+    assert responses.get("key") == "answer"
+    clock[0] += 2
+    assert responses.get("key") is None
+    # Expired rows are gone from disk too
+    assert ResponseCache(db_path, ttl=60).get("key") is None
+
+
+def test_response_cache_evicts_least_recently_used_from_memory(db_path):
+    responses = ResponseCache(db_path, maxsize=2)
+    responses.set("a", "1")
+    responses.set("b", "2")
+    responses.get("a")
+    responses.set("c", "3")
+    assert list(responses._memory) == ["a", "c"]
+    # Evicted entries are still served from disk
+    assert responses.get("b") == "2"
+
+
+def test_semantic_lookup_applies_threshold(db_path):
+    semantic = SemanticCache(db_path, threshold=0.85)
+    semantic.store("chat", [1.0, 0.0], "answer")
+    assert semantic.lookup("chat", [2.0, 0.1]) == "answer"
+    assert semantic.lookup("chat", [0.6, 0.8]) is None
+
+
+def test_semantic_lookup_is_scoped_to_namespace_and_media(db_path):
+    semantic = SemanticCache(db_path)
+    semantic.store("chat", [1.0, 0.0], "photo answer", media_key="digest")
+    assert semantic.lookup("other chat", [1.0, 0.0], media_key="digest") is None
+    assert semantic.lookup("chat", [1.0, 0.0]) is None
+    assert semantic.lookup("chat", [1.0, 0.0], media_key="digest") == "photo answer"
+
+
+def test_semantic_has_entries_only_counts_live_rows(db_path, clock):
+    semantic = SemanticCache(db_path, ttl=60)
+    assert not semantic.has_entries("chat")
+    semantic.store("chat", [1.0, 0.0], "answer")
+    assert semantic.has_entries("chat")
+    assert not semantic.has_entries("other chat")
+    assert not semantic.has_entries("chat", media_key="digest")
+    clock[0] += 61
+    assert not semantic.has_entries("chat")
+
+
+def test_semantic_lookup_skips_expired_entries(db_path, clock):
+    semantic = SemanticCache(db_path, ttl=60)
+    semantic.store("chat", [1.0, 0.0], "answer")
+    clock[0] += 61
+    assert semantic.lookup("chat", [1.0, 0.0]) is None
+
+
+def test_partial_matches_need_enough_combined_similarity(db_path):
+    semantic = SemanticCache(db_path, partial_threshold=0.6, combined_threshold=1.4)
+    query = [1.0, 0.0, 0.0]
+    semantic.store("chat", [0.8, 0.6, 0.0], "first part")
+    # A single 0.8 match doesn't cover the prompt
+    assert semantic.partial_matches("chat", query) == []
+
+    semantic.store("chat", [0.9, 0.0, 0.436], "second part")
+    semantic.store("chat", [0.0, 1.0, 0.0], "unrelated")
+    assert semantic.partial_matches("chat", query) == ["second part", "first part"]
+    assert semantic.partial_matches("chat", query, k=1) == []
+
+
+def test_semantic_store_caps_entries_per_namespace(db_path):
+    semantic = SemanticCache(db_path, max_entries=2)
+    semantic.store("chat", [1.0, 0.0, 0.0], "oldest")
+    semantic.store("chat", [0.0, 1.0, 0.0], "middle")
+    semantic.store("chat", [0.0, 0.0, 1.0], "newest")
+    semantic.store("other chat", [1.0, 0.0, 0.0], "kept")
+    assert semantic.lookup("chat", [1.0, 0.0, 0.0]) is None
+    assert semantic.lookup("chat", [0.0, 1.0, 0.0]) == "middle"
+    assert semantic.lookup("other chat", [1.0, 0.0, 0.0]) == "kept"
+
+
+def test_quiz_pool_is_first_in_first_out_and_bounded(db_path):
+    pool = QuizPool(db_path, maxlen=2)
+    key = ("Math", "easy", 1)
+    assert pool.pop(key) is None
+    for question in ("q1", "q2", "q3"):
+        pool.add(key, question)
+    assert pool.size(key) == 2
+    assert pool.pop(key) == "q2"
+    assert pool.pop(key) == "q3"
+    assert pool.size(key) == 0
+
+
+def test_quiz_pool_save_replaces_stored_questions(db_path):
+    pool = QuizPool(db_path)
+    math, history = ("Math", "easy", 1), ("History", "hard", 3)
+    pool.add(math, "q1")
+    pool.add(math, "q2")
+    pool.add(history, "h1")
+    pool.save()
+    pool.pop(math)
+    pool.save()
+
+    reloaded = QuizPool(db_path)
+    assert reloaded.size(math) == 1
+    assert reloaded.pop(math) == "q2"
+    assert reloaded.pop(history) == "h1"
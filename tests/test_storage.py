@@ -0,0 +1,61 @@
+"""
+Tests for the user profile store
+"""
+
+import pytest
+
+from studysage.storage import SUBJECT_BITS, SUBJECTS, UserState, UserStore, subject_names
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "users.db")
+
+
+def test_subject_bits_follow_subject_order():
+    assert [SUBJECT_BITS[name] for name in SUBJECTS] == [1 << i for i in range(len(SUBJECTS))]
+
+
+def test_subject_names_lists_set_bits_in_order():
+    mask = SUBJECT_BITS['Biology'] | SUBJECT_BITS['Math'] | SUBJECT_BITS['History']
+    assert list(subject_names(mask)) == ['Math', 'History', 'Biology']
+    assert list(subject_names(0)) == []
+
+
+def test_unknown_user_has_no_profile(db_path):
+    assert UserStore(db_path).get(42) is None
+
+
+def test_profile_round_trips_through_disk(db_path):
+    profile = UserState(
+        study_streak=3,
+        total_questions=8,
+        correct_answers=6,
+        accuracy=75.0,
+        subjects_studied=SUBJECT_BITS['Physics'],
+        last_activity=1_700_000_000.5,
+        level=2,
+        xp=140,
+        difficulty='hard',
+        favorite_subjects=['Physics']
+    )
+    UserStore(db_path).save(42, profile)
+    assert UserStore(db_path).get(42) == profile
+
+
+def test_saving_replaces_the_stored_profile(db_path):
+    users = UserStore(db_path)
+    users.save(42, UserState(xp=10))
+    users.save(42, UserState(xp=20))
+    assert UserStore(db_path).get(42).xp == 20
+
+
+def test_memory_keeps_only_recently_used_profiles(db_path):
+    users = UserStore(db_path, maxsize=2)
+    users.save(1, UserState(xp=1))
+    users.save(2, UserState(xp=2))
+    users.get(1)
+    users.save(3, UserState(xp=3))
+    assert list(users._memory) == [1, 3]
+    # Evicted profiles load from disk again
+    assert users.get(2).xp == 2